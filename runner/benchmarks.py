@@ -9,7 +9,6 @@ from pathlib import Path
 from . import bitcoind, results, sh, config, hwinfo, logparse
 from .globals import G
 from .logging import get_logger
-from .sh import popen
 from .results import HeightData
 
 logger = get_logger()
@@ -76,6 +75,12 @@ class Benchmark(abc.ABC):
         """Any teardown that should always happen after the benchmark."""
         pass
 
+    @property
+    def repo_path(self) -> Path:
+        """The bitcoin checkout this benchmark builds and runs from."""
+        assert self.cfg.workdir
+        return self.target.worktree or self.cfg.workdir / "bitcoin"
+
     @property
     def artifacts_dir(self) -> Path:
         """A place to stash various artifacts from the benchmark."""
@@ -100,7 +105,7 @@ class Benchmark(abc.ABC):
 
     def run(self, cfg, bench_cfg) -> None:
         """Called externally."""
-        sh.drop_caches()
+        sh.drop_caches(fallback_paths=self._cached_paths())
 
         G.benchmark = self.__class__
 
@@ -118,6 +123,14 @@ class Benchmark(abc.ABC):
 
         logger.info("[%s] done", self.id or self.name)
 
+    def _cached_paths(self) -> t.List[Path]:
+        """Paths whose cached pages could skew this benchmark's results."""
+        paths = [self.cfg.workdir]
+        src_datadir = getattr(self.bench_cfg, "src_datadir", None)
+        if src_datadir:
+            paths.append(src_datadir)
+        return paths
+
     def _try_execute_and_report(self, cmd_str, *, num_tries=1):
         """
         Attempt to execute some command a number of times and then report
@@ -146,7 +159,7 @@ class Benchmark(abc.ABC):
 
             assert self.cfg.workdir
             self.results.configure_info = hwinfo.parse_configure_log(
-                self.cfg.workdir / "bitcoin"
+                self.repo_path
             )
 
             results.report_result(self, self.id, cmd.total_secs)
@@ -179,6 +192,12 @@ class Build(Benchmark):
     name = "build"
     id_format = "build.make.{bench_cfg.num_jobs}.{self.compiler}"
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.bench_cfg.use_ccache:
+            # Keep warm-cache timings apart from the usual cold builds.
+            self.id += ".ccache"
+
     def _run(self, cfg, bench_cfg):
         sh.cd(cfg.workdir)
         num_jobs = bench_cfg.num_jobs
@@ -186,6 +205,7 @@ class Build(Benchmark):
             cfg.workdir,
             cfg.build_cache_path(),
             clean=cfg.clean,
+            repo_path=self.repo_path,
         )
         self.results.title = f"Build with {self.compiler} (j={num_jobs})"
         cmd = builder.build(
@@ -193,9 +213,18 @@ class Build(Benchmark):
             self.compiler,
             num_jobs=bench_cfg.num_jobs,
             copy_log_to=self.artifacts_dir,
+            use_ccache=bench_cfg.use_ccache,
         )
         if cmd:  # i.e. if not cached
             self._report_results(cmd)
+
+            hit_rate = (
+                bitcoind.ccache_hit_rate() if bench_cfg.use_ccache else None)
+            if hit_rate is not None:
+                logger.info("[%s] ccache hit rate: %.1f%%", self.id, hit_rate)
+                results.report_result(
+                    self, self.id + ".ccache-hitrate", hit_rate,
+                    report_to_codespeed=False)
             if cmd.returncode != 0:
                 raise RuntimeError(
                     f"{self.target} failed to build with {self.compiler} "
@@ -222,7 +251,7 @@ class FunctionalTests(Benchmark):
     id_format = "functionaltests.{self.compiler}.j={bench_cfg.num_jobs}"
 
     def _run(self, cfg, bench_cfg):
-        cmd = "./test/functional/test_runner.py"
+        cmd = f"./test/functional/test_runner.py --jobs={bench_cfg.num_jobs}"
         self.results.title = "Functional tests"
         self._try_execute_and_report(cmd, num_tries=3)
 
@@ -233,7 +262,7 @@ class Microbench(Benchmark):
     _results_class = results.MicrobenchResults
 
     def _run(self, cfg, bench_cfg):
-        time_start = time.time()
+        time_start = time.perf_counter()
         sh.drop_caches()
         cmd_str = "./src/bench/bench_bitcoin"
 
@@ -241,25 +270,30 @@ class Microbench(Benchmark):
             cmd_str += " -filter='{}'".format(bench_cfg.filter)
 
         outpath = self.artifacts_dir / f"{self.id}_results"
-        # TODO: use sh.Command, report peak memory usage - maybe per bench?
-        cmd_str += f" -output-csv={outpath} > /dev/null && cat {outpath}"
-
-        microbench_ps = popen(cmd_str)
-        (microbench_stdout, microbench_stderr) = microbench_ps.communicate()
+        # TODO: report peak memory usage - maybe per bench?
+        cmd_str += f" -output-csv={outpath}"
+
+        # Output goes to tempfiles of which only the tail is read back, so
+        # however chatty bench_bitcoin gets it isn't buffered in memory.
+        cmd = sh.Command(cmd_str, self.name)
+        cmd.start()
+        cmd.join()
         self.results.command = cmd_str
         self.results.title = "Microbench"
-        self.results.total_time_secs = time.time() - time_start
+        self.results.total_time_secs = time.perf_counter() - time_start
 
         # Don't use _try_execute_and_report because we need to report each
         # microbenchmark individually.
 
-        if microbench_ps.returncode != 0:
+        if cmd.returncode != 0:
+            assert cmd.stdout is not None
+            assert cmd.stderr is not None
             text = "stdout:\n%s\nstderr:\n%s" % (
-                microbench_stdout.decode(),
-                microbench_stderr.decode(),
+                cmd.stdout.decode()[-10000:],
+                cmd.stderr.decode()[-10000:],
             )
 
-            msg = "Microbench exited with code %s" % microbench_ps.returncode
+            msg = "Microbench exited with code %s" % cmd.returncode
             if G.slack:
                 G.slack.send_to_slack_attachment(
                     self.gitco, msg, {}, text=text, success=False
@@ -268,34 +302,36 @@ class Microbench(Benchmark):
                 logger.warning(f"{msg} on {self.gitco}:\n{text}")
             return
 
-        microbench_lines = [
-            # Skip the first line (header)
-            i.decode().split(", ")
-            for i in microbench_stdout.splitlines()[1:]
-        ]
-
-        for line in microbench_lines:
-            # Line strucure is
-            # "Benchmark, evals, iterations, total, min, max, median"
-            assert len(line) == 7
-            (bench, median, max_, min_) = (
-                line[0],
-                float(line[-1]),
-                float(line[-2]),
-                float(line[-3]),
-            )
-            if not max_ >= median >= min_:
-                logger.warning(
-                    "%s has weird results: %s, %s, %s" % (bench, max_, median, min_)
-                )
-                assert False
-            self.results.bench_to_time[bench] = median
-            results.report_result(
-                self,
-                "micro.{compiler}.{bench}".format(compiler=self.compiler, bench=bench),
-                median,
-                extra_data={"result_max": max_, "result_min": min_},
+        # Read the results straight from the CSV, a line at a time, rather
+        # than buffering them through stdout.
+        with open(outpath) as csvfile:
+            next(csvfile, None)  # Skip the header
+            for raw_line in csvfile:
+                if raw_line.strip():
+                    self._report_microbench_line(raw_line.rstrip("\n").split(", "))
+
+    def _report_microbench_line(self, line: t.List[str]):
+        # Line strucure is
+        # "Benchmark, evals, iterations, total, min, max, median"
+        assert len(line) == 7
+        (bench, median, max_, min_) = (
+            line[0],
+            float(line[-1]),
+            float(line[-2]),
+            float(line[-3]),
+        )
+        if not max_ >= median >= min_:
+            logger.warning(
+                "%s has weird results: %s, %s, %s" % (bench, max_, median, min_)
             )
+            assert False
+        self.results.bench_to_time[bench] = median
+        results.report_result(
+            self,
+            "micro.{compiler}.{bench}".format(compiler=self.compiler, bench=bench),
+            median,
+            extra_data={"result_max": max_, "result_min": min_},
+        )
 
 
 class _IbdBench(Benchmark):
@@ -440,6 +476,10 @@ class _IbdBench(Benchmark):
         iters = 0
         time_now = None
 
+        # getblockchaininfo does a lot more work within the node under test
+        # than getblockcount, so only ask for progress if we're syncing to tip.
+        with_progress = not bench_cfg.end_height
+
         # Poll the running bitcoind process for its current height and report
         # results whenever we've crossed one of the user-specific checkpoints.
         #
@@ -448,19 +488,20 @@ class _IbdBench(Benchmark):
                 logger.info("node process died: %s", client_node)
                 break
 
-            (last_height_seen, progress) = client_node.poll_for_height_and_progress()
+            (last_height_seen, progress) = client_node.poll_for_height_and_progress(
+                with_progress)
 
             logger.debug("Last saw height=%s progress=%s", last_height_seen, progress)
 
-            if last_height_seen is None and progress is None:
+            if last_height_seen is None:
                 raise RuntimeError("RPC calls to {} failed".format(client_node))
 
             elif (
                 bench_cfg.end_height and last_height_seen >= bench_cfg.end_height
-            ) or progress > 0.9999:
+            ) or (progress is not None and progress > 0.9999):
                 # Be sure we've set start time in case the bench finished
                 # really fast.
-                start_time = start_time or time.time()
+                start_time = start_time or time.perf_counter()
 
                 logger.info(
                     "ending IBD based on height (%s) or progress (%s)",
@@ -478,8 +519,8 @@ class _IbdBench(Benchmark):
                 time.sleep(0.5)
                 continue
 
-            start_time = start_time or time.time()
-            time_now = time.time() - start_time
+            start_time = start_time or time.perf_counter()
+            time_now = time.perf_counter() - start_time
             last_resource_usage = client_node.cmd.get_resource_usage()
 
             # Codespeed
@@ -523,12 +564,21 @@ class _IbdBench(Benchmark):
                 )
 
             iters += 1
-            time.sleep(1)
 
-        final_time = time.time() - start_time
+            # Wake up as soon as the next height we care about is reached so
+            # that its timing isn't skewed by the polling interval.
+            next_heights = report_to_codespeed_heights[:1] + [bench_cfg.end_height]
+            next_height = min((h for h in next_heights if h), default=None)
+
+            if next_height:
+                client_node.wait_for_height(next_height, timeout_secs=1)
+            else:
+                time.sleep(1)
+
+        final_time = time.perf_counter() - start_time
         final_name = self._get_codespeed_bench_name(last_height_seen)
 
-        before_shutdown = time.time()
+        before_shutdown = time.perf_counter()
 
         if client_node.ps.returncode is None:
             # Longer timeout - might be flushing cache
@@ -536,7 +586,7 @@ class _IbdBench(Benchmark):
         else:
             client_node.ps.join()
 
-        logger.info("Shutdown took %s seconds", time.time() - before_shutdown)
+        logger.info("Shutdown took %s seconds", time.perf_counter() - before_shutdown)
 
         # Don't finalize results if the IBD was a failure.
         #
@@ -571,7 +621,7 @@ class _IbdBench(Benchmark):
 
         # Record the time-to-tip if we didn't specify an end height.
         #
-        if progress > 0.999 and not bench_cfg.end_height:
+        if not bench_cfg.end_height and progress > 0.999:
             results.report_result(
                 self,
                 self._get_codespeed_bench_name("tip"),
@@ -643,6 +693,15 @@ class _IbdBench(Benchmark):
                 )
                 sh.rm(self.bench_cfg.stash_datadir)
 
+            # On the same filesystem this is a rename; otherwise it's a full
+            # copy of the datadir, which can take a very long time.
+            if datadirpath.stat().st_dev != \
+                    self.bench_cfg.stash_datadir.parent.stat().st_dev:
+                logger.warning(
+                    "stash_datadir (%s) is on a different filesystem than %s; "
+                    "stashing will copy the whole datadir",
+                    self.bench_cfg.stash_datadir, datadirpath)
+
             shutil.move(datadirpath, self.bench_cfg.stash_datadir)
             logger.info(
                 "Stashed datadir from %s -> %s",
@@ -660,9 +719,10 @@ class IbdLocal(_IbdBench):
 
     def _get_client_node(self):
         self.client_node = bitcoind.Node(
-            self.cfg.workdir / "bitcoin",
+            self.repo_path,
             self.cfg.workdir / "data",
             extra_args=self.target.bitcoind_extra_args,
+            env=self.target.bitcoind_env,
         )
 
         self.client_node.empty_datadir()
@@ -692,10 +752,11 @@ class IbdRangeLocal(_IbdBench):
 
     def _get_client_node(self):
         self.client_node = bitcoind.Node(
-            self.cfg.workdir / "bitcoin",
+            self.repo_path,
             self.cfg.workdir / "data",
             copy_from_datadir=self.bench_cfg.src_datadir,
             extra_args=self.target.bitcoind_extra_args,
+            env=self.target.bitcoind_env,
         )
 
         # Don't empty datadir since we just copied it from a pruned source.
@@ -730,9 +791,10 @@ class IbdReal(_IbdBench):
 
     def _get_client_node(self):
         self.client_node = bitcoind.Node(
-            self.cfg.workdir / "bitcoin",
+            self.repo_path,
             self.cfg.workdir / "data",
             extra_args=self.target.bitcoind_extra_args,
+            env=self.target.bitcoind_env,
         )
 
         self.client_node.empty_datadir()
@@ -753,9 +815,10 @@ class Reindex(_IbdBench):
 
     def _get_client_node(self):
         self.client_node = bitcoind.Node(
-            self.cfg.workdir / "bitcoin",
+            self.repo_path,
             self.bench_cfg.src_datadir,
             extra_args=self.target.bitcoind_extra_args,
+            env=self.target.bitcoind_env,
         )
 
         self.client_node.start(reindex=1)
@@ -775,9 +838,10 @@ class ReindexChainstate(_IbdBench):
 
     def _get_client_node(self):
         self.client_node = bitcoind.Node(
-            self.cfg.workdir / "bitcoin",
+            self.repo_path,
             self.bench_cfg.src_datadir,
             extra_args=self.target.bitcoind_extra_args,
+            env=self.target.bitcoind_env,
         )
 
         self.client_node.start(**{"reindex-chainstate": 1})
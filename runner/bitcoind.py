@@ -1,14 +1,15 @@
+import functools
 import json
+import shlex
 import time
 import typing as t
 import socket
-import shutil
 import os
 import glob
 import textwrap
 from pathlib import Path
 
-from . import sh, logging, config, git
+from . import sh, logging, config, git, util
 
 logger = logging.get_logger()
 
@@ -16,22 +17,35 @@ logger = logging.get_logger()
 _BENCH_SPECIFIC_BITCOIND_ARGS = (
     # To "complete" (i.e. latch false out of) initialblockdownload for
     # stopatheight for a lowish height, we need to set a very large maxtipage.
-    '-maxtipage=99999999999999999999 '
+    '-maxtipage=99999999999999999999',
 
     # If we don't set minimumchainwork to 0, low heights may cause the syncing
     # peer to never download blocks and thus hang indefinitely during IBD.
     # See https://github.com/bitcoin/bitcoin/blob/e83d82a85c53196aff5b5ac500f20bb2940663fa/src/net_processing.cpp#L517-L521  # noqa
-    '-minimumchainwork=0x00 '
+    '-minimumchainwork=0x00',
 
     # Output buffering into memory during ps.communicate() can cause OOM errors
     # on machines with small memory, so only output to debug.log files in disk.
-    '-printtoconsole=0 '
+    '-printtoconsole=0',
 )
 
 DEFAULT_ASSUMEVALID = (
     '000000000000000000176c192f42ad13ab159fdb20198b87e7ba3c001e47b876')
 DEFAULT_DBCACHE = 300
 
+# How long to wait for a started node to answer RPC before giving up.
+STARTUP_TIMEOUT_SECS = 600
+
+# Polling for startup begins at the first interval and backs off to the max.
+STARTUP_POLL_MIN_SECS = 0.05
+STARTUP_POLL_MAX_SECS = 1.0
+
+# Written into a configured tree; see `BuildManager._configure_key()`.
+CONFIGURE_KEY_FILENAME = '.bitcoinperf-configure-key'
+
+# How much of the end of debug.log to search for recent warnings.
+DEBUG_LOG_TAIL_BYTES = 2_000_000
+
 
 class Node:
     """
@@ -49,12 +63,19 @@ class Node:
                  port: int = None,
                  rpcport: int = None,
                  extra_args: str = None,
+                 env: t.Dict[str, str] = None,
+                 pin_to_bench_cpus: bool = True,
                  ):
         """
         Kwargs:
             copy_from_datadir: if specified, initialize the datadir contents of
                 this node from the specified path.
 
+            env: extra environment variables to run bitcoind with.
+
+            pin_to_bench_cpus: False for nodes that aren't being benchmarked,
+                to keep them off the benchmark CPUs.
+
             If port and rpcport are left unspecified, unused ports will be
                 found and used automatically.
         """
@@ -64,13 +85,15 @@ class Node:
         self.port = port or _find_unused_port()
         self.rpcport = rpcport or _find_unused_port(self.port + 1)
         self.extra_args = extra_args or ''
+        self.env = env or {}
+        self.pin_to_bench_cpus = pin_to_bench_cpus
 
         if copy_from_datadir:
             if self.datadir.exists():
                 sh.rm(self.datadir)
             logger.info(
                 f'Seeding datadir from {copy_from_datadir} -> {self.datadir}')
-            shutil.copytree(copy_from_datadir, self.datadir)
+            sh.copytree(copy_from_datadir, self.datadir)
         else:
             self.datadir.mkdir(exist_ok=True)
 
@@ -98,8 +121,7 @@ class Node:
 
     @property
     def is_process_alive(self):
-        self.ps.poll()
-        return self.ps and self.ps.returncode is None
+        return self.cmd and self.cmd.ps and self.cmd.poll() is None
 
     @property
     def ps(self):
@@ -109,40 +131,43 @@ class Node:
 
     def start(self, **kwargs):
         self.started_args.append(dict(kwargs))
-        cmd = ''
+        # Built as an argv list so that bitcoind is exec'd without a shell.
+        argv = [
+            str(self.repo_path / 'src' / 'bitcoind'),
+            f'-datadir={self.datadir}',
+            *shlex.split(self.extra_args),
+        ]
 
         if 'dbcache' in kwargs:
-            cmd += '-dbcache={} '.format(kwargs.pop('dbcache'))
+            argv.append(f"-dbcache={kwargs.pop('dbcache')}")
         elif 'dbcache' not in self.extra_args:
-            cmd += '-dbcache={} '.format(DEFAULT_DBCACHE)
+            argv.append(f'-dbcache={DEFAULT_DBCACHE}')
 
         # Supply a default assumevalid value unless the user has overridden it
         # at some point.
         if 'assumevalid' in kwargs:
-            cmd += '-assumevalid={} '.format(kwargs.pop('assumevalid'))
+            argv.append(f"-assumevalid={kwargs.pop('assumevalid')}")
         elif 'assumevalid' not in self.extra_args:
-            cmd += '-assumevalid={} '.format(DEFAULT_ASSUMEVALID)
+            argv.append(f'-assumevalid={DEFAULT_ASSUMEVALID}')
 
         if kwargs.get('debug'):
-            cmd += '-debug={} '.format(kwargs['debug'])
+            argv.append(f"-debug={kwargs['debug']}")
         else:
-            cmd += '-debug=coindb -debug=bench '
+            argv += ['-debug=coindb', '-debug=bench']
 
         # Add remaining arguments
-        for k, v in kwargs.items():
-            cmd += '-{}={} '.format(k, v)
-
-        cmd += '{} -port={} -rpcport={}'.format(
-            _BENCH_SPECIFIC_BITCOIND_ARGS, self.port, self.rpcport)
+        argv += [f'-{k}={v}' for k, v in kwargs.items()]
 
-        run_cmd = '{} -datadir={} {} {}'.format(
-            self.repo_path / 'src' / 'bitcoind',
-            self.datadir, self.extra_args, cmd)
+        argv += [
+            *_BENCH_SPECIFIC_BITCOIND_ARGS,
+            f'-port={self.port}', f'-rpcport={self.rpcport}']
 
-        self.start_time = time.time()
-        self.cmd = sh.Command(run_cmd, 'run node {}'.format(self))
+        self.start_time = time.perf_counter()
+        self.cmd = sh.Command(
+            argv, 'run node {}'.format(self), env=self.env,
+            pin_to_bench_cpus=self.pin_to_bench_cpus)
         self.cmd.start()
-        logger.debug("command '%s' starting for %s", run_cmd, self)
+        logger.debug("command '%s' starting for %s", self.cmd.cmd, self)
 
     def get_args_dict(self) -> t.Dict[str, str]:
         """
@@ -150,8 +175,7 @@ class Node:
         with.
         """
         assert self.cmd
-        args = self.cmd.cmd.split('bitcoind')[-1].split()
-        args = [a.lstrip('-') for a in args]
+        args = [a.lstrip('-') for a in self.cmd.args[1:]]
         d = {}
         ignore_keys = [
             'connect', 'addnode', 'rpcport', 'datadir', 'port']
@@ -160,7 +184,7 @@ class Node:
             if any(a.startswith(i) for i in ignore_keys):
                 continue
             if '=' in a:
-                k, v = a.split('=')
+                k, v = a.split('=', 1)
                 d[k] = v
             else:
                 d[a] = '1'
@@ -177,12 +201,14 @@ class Node:
         Returns block count, if node successfully started.
         """
         assert self.cmd
-        num_tries = 600
-        sleep_time_secs = 1
+        deadline = time.perf_counter() + STARTUP_TIMEOUT_SECS
+        # Start polling quickly so that a node that comes up fast isn't
+        # held up by a coarse sleep.
+        backoff = STARTUP_POLL_MIN_SECS
         bitcoind_up = False
         block_count = None
 
-        while num_tries > 0 and self.is_process_alive and not bitcoind_up:
+        while self.is_process_alive and not bitcoind_up:
             info = self.call_rpc("getblockchaininfo")
 
             if info and require_height and info["blocks"] < require_height:
@@ -195,8 +221,13 @@ class Node:
                 bitcoind_up = True
                 block_count = int(info['blocks'])
             else:
-                num_tries -= 1
-                time.sleep(sleep_time_secs)
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                # Returns early if the node dies, rather than waiting out the
+                # backoff.
+                self.cmd.wait_for_exit(min(backoff, remaining))
+                backoff = min(backoff * 2, STARTUP_POLL_MAX_SECS)
 
         if not self.is_process_alive:
             self.cmd.join()
@@ -223,9 +254,11 @@ class Node:
         """
         Call some bitcoin RPC command and return its deserialized output.
         """
+        # This is called in tight polling loops, so skip the shell.
         call = sh.run(
-            "{} -rpcport={} -datadir={} {}".format(
-                self.bitcoincli_bin_path, self.rpcport, self.datadir, cmd),
+            [str(self.bitcoincli_bin_path),
+             f"-rpcport={self.rpcport}", f"-datadir={self.datadir}",
+             *shlex.split(cmd)],
             check=False)
 
         # Ignore these lest we spam the logs.
@@ -241,7 +274,7 @@ class Node:
                              self, call)
             return None
 
-        if config.BITCOINPERF_TRACE:
+        if config.LOG_TRACE:
             if not deserialize_output:
                 logger.debug("rpc: %r -> %r", cmd, call.stdout)
             else:
@@ -249,6 +282,22 @@ class Node:
 
         return json.loads(call.stdout) if deserialize_output else None
 
+    def wait_for_height(self, height: int, timeout_secs: float = 1.0):
+        """
+        Block until the node has connected `height` or `timeout_secs` passes.
+
+        Uses the waitforblockheight RPC so that we return as soon as the block
+        is connected rather than at the next polling interval. Older versions
+        without that RPC just sleep for the timeout.
+        """
+        started = time.perf_counter()
+        res = self.call_rpc(
+            "waitforblockheight {} {}".format(height, int(timeout_secs * 1000)),
+            quiet=True)
+
+        if res is None:
+            time.sleep(max(0, timeout_secs - (time.perf_counter() - started)))
+
     def stop_via_rpc(self, timeout=None):
         logger.info("Calling stop on %s", self)
         self.call_rpc("stop", deserialize_output=False)
@@ -260,44 +309,53 @@ class Node:
 
     def empty_datadir(self):
         """Ensure empty data before each IBD."""
-        sh.run("rm -rf %s" % self.datadir, check=False)
+        sh.rmtree(self.datadir)
         if not self.datadir.exists():
             self.datadir.mkdir()
 
-    def check_disk_low(self):
-        disk_warning_ps = sh.run(
-            ("tail -n 10000 {}/debug.log | "
-             "grep 'Disk space is low!' ").format(self.datadir))
-
-        # True if we're low on disk
-        return disk_warning_ps.returncode == 0
+    def check_disk_low(self) -> bool:
+        """True if bitcoind has recently logged that it's low on disk."""
+        try:
+            tail = sh.read_tail(self.datadir / 'debug.log', DEBUG_LOG_TAIL_BYTES)
+        except OSError:
+            return False
+        return b'Disk space is low!' in tail
 
     def join(self, timeout=None):
         return self.cmd.join(timeout=timeout)
 
-    def poll_for_height_and_progress(self) -> \
+    def poll_for_height_and_progress(self, with_progress: bool = True) -> \
             t.Tuple[t.Optional[int], t.Optional[float]]:
         """
         Returns the current height and verification progress.
 
         Returns nothing if the RPC command didn't respond successfully.
+
+        Args:
+            with_progress: if False, only fetch the height (via the much
+                cheaper getblockcount) and return None for the progress.
         """
         tries_left = 20
         info = None
 
-        while tries_left > 0 and not info:
-            info = self.call_rpc("getblockchaininfo")
+        while tries_left > 0 and info is None:
+            info = self.call_rpc(
+                "getblockchaininfo" if with_progress else "getblockcount")
 
-            if not info:
+            if info is None:
                 tries_left -= 1
                 time.sleep(1)
 
-        if not info:
+        if info is None:
             logger.error(
                 "Bitcoind hasn't responded to RPC in a suspiciously "
                 "long time... hung?")
             return (None, None)
 
+        if not with_progress:
+            logger.debug("[%s] saw height %s", self, info)
+            return (int(info), None)
+
         last_height_seen = info['blocks']
         logger.debug("[%s] saw height %s", self, last_height_seen)
 
@@ -355,13 +413,15 @@ def get_synced_node(
         logger.info(f'Starting build for synced peer ({peer_config})')
         target = target or config.Target(gitref=peer_config.gitref, rebase=False)
         assert peer_config.repodir
-        [co], _ = git.resolve_targets(peer_config.repodir, [target])
+        [co], _ = git.resolve_targets(
+            peer_config.repodir, [target], fetch_ttl_secs=cfg.fetch_ttl_secs)
         git.checkout_in_dir(peer_config.repodir, target)
         builder = BuildManager(
             peer_config.repodir.parent,
             repo_path=peer_config.repodir,
             cache_path=cfg.build_cache_path(),
-            clean=False)
+            clean=False,
+            pin_to_bench_cpus=False)
         cmd = builder.build(target, config.Compilers.gcc)
 
         if cmd and cmd.returncode != 0:  # i.e. if build was not cached
@@ -377,6 +437,8 @@ def get_synced_node(
         peer_config.repodir,
         peer_config.datadir,
         extra_args=peer_config.bitcoind_extra_args,
+        # The peer only serves blocks; keep it off the benchmark CPUs.
+        pin_to_bench_cpus=False,
     )
     server.start(connect=0, listen=1)
     server.wait_for_init(require_height=required_height)
@@ -393,15 +455,18 @@ class BuildManager:
                  workdir: Path,
                  cache_path: t.Optional[Path] = None,
                  clean: bool = True,
-                 repo_path: Path = None):
+                 repo_path: Path = None,
+                 pin_to_bench_cpus: bool = True):
         """
         Args:
             cache_path: if given, cache builds at this location.
             clean: should run `make distclean`?
+            pin_to_bench_cpus: False if the build isn't being benchmarked.
         """
         self.workdir = workdir
         self.cache_path = cache_path
         self.clean = clean
+        self.pin_to_bench_cpus = pin_to_bench_cpus
         self.repo_path = repo_path or self.workdir / 'bitcoin'
 
     def build(self,
@@ -409,7 +474,8 @@ class BuildManager:
               compiler: config.Compilers,
               *,
               num_jobs: t.Optional[int] = None,
-              copy_log_to: t.Optional[Path] = None
+              copy_log_to: t.Optional[Path] = None,
+              use_ccache: bool = False,
               ) -> t.Optional[sh.Command]:
         """
         Checks out the bitcoin repo to the desired target and builds
@@ -429,17 +495,23 @@ class BuildManager:
 
         git.checkout_in_dir(self.repo_path, target)
 
-        # Sanity check - compare the commit message as an extra assurance.
-        msg = git.get_commit_msg('HEAD')
+        # Sanity check - compare the sha and commit message as an extra
+        # assurance.
+        sha, msg = git.get_head_info()
         assert target.gitco
-        if msg != target.gitco.commit_msg:
+        if not sha.startswith(target.gitco.sha):
+            raise RuntimeError(
+                "checkout {} has bad HEAD (expected {}, got {})!".format(
+                    self.repo_path, target.gitco.sha, sha))
+        elif msg != target.gitco.commit_msg:
             raise RuntimeError(
                 "checkout {} has bad HEAD (expected '{}', got '{}')!".format(
                     self.repo_path, target.gitco.commit_msg, msg))
 
-        num_jobs = num_jobs or config.DEFAULT_NPROC
+        num_jobs = num_jobs or config.default_nproc()
 
-        cache = BuildCache(self.workdir, compiler, self.cache_path)
+        cache = BuildCache(
+            self.workdir, compiler, self.cache_path, repo_path=self.repo_path)
         if self.cache_path and cache.restore(target):
             return None
 
@@ -455,44 +527,70 @@ class BuildManager:
         if compiler == config.Compilers.clang:
             configure_prefix = 'CC=clang CXX=clang++ '
 
-        # Ensure build is clean.
-        makefile_path = self.repo_path / 'Makefile'
-        if makefile_path.is_file() and self.clean:
-            sh.run('make distclean')
-
-        boostflags = ''
-        armlib_path = '/usr/lib/arm-linux-gnueabihf/'
-
-        if Path(armlib_path).is_dir():
-            # On some architectures we need to manually specify this,
-            # otherwise configuring with clang can fail.
-            boostflags = '--with-boost-libdir=%s' % armlib_path
-
-        logger.info("Running ./configure ...")
-        conf = sh.run(
+        configure_cmd = (
             configure_prefix +
             './configure --with-incompatible-bdb ' +
             '--without-gui ' +  # TODO maybe make this configurable?
             target.configure_args +
-            # Ensure ccache is disabled so that subsequent make runs
-            # are timed accurately.
-            '--disable-ccache ' + boostflags)
-
-        if not conf.ok:
-            logger.error(conf.failure_msg(f"configure failed for {target}"))
-            if copy_log_to:
-                sh.run(f'cp config.log {copy_log_to}/config.log')
-                logger.info("Saved configure output to %s", copy_log_to)
-            raise RuntimeError('configure failed')
-
-        logger.info(f"Running make -j {num_jobs}")
-        cmd = sh.Command(f"make -j {num_jobs}")
+            # Unless asked for, ensure ccache is disabled so that subsequent
+            # make runs are timed accurately.
+            ('' if use_ccache else '--disable-ccache ') + _boost_flags())
+
+        # Skip configuring if the tree was last configured the same way from
+        # the same build system inputs; `make clean` above already removed
+        # the build products.
+        makefile_path = self.repo_path / 'Makefile'
+        configure_key_path = self.repo_path / CONFIGURE_KEY_FILENAME
+        configure_key = self._configure_key(configure_cmd)
+        try:
+            reconfigure = not (
+                makefile_path.is_file() and
+                configure_key_path.read_text() == configure_key)
+        except OSError:
+            reconfigure = True
+
+        if not reconfigure:
+            logger.info("Configuration unchanged; skipping ./configure")
+        else:
+            # Ensure build is clean.
+            if makefile_path.is_file() and self.clean:
+                sh.run('make distclean')
+
+            if configure_key_path.exists():
+                configure_key_path.unlink()
+
+            logger.info("Running ./configure ...")
+            conf = sh.run(configure_cmd)
+
+            if not conf.ok:
+                logger.error(conf.failure_msg(f"configure failed for {target}"))
+                if copy_log_to:
+                    sh.run(f'cp config.log {copy_log_to}/config.log')
+                    logger.info("Saved configure output to %s", copy_log_to)
+                raise RuntimeError('configure failed')
+
+            configure_key_path.write_text(configure_key)
+
+        make_cmd = f"make -j {num_jobs}"
+        if use_ccache:
+            # Each target builds in its own worktree, so have ccache hash
+            # paths relative to the checkout (and ignore the cwd baked into
+            # debug info) for builds of different targets and runs to share
+            # cache entries.
+            make_cmd = (
+                f"CCACHE_DIR={config.ccache_dir} CCACHE_BASEDIR={self.repo_path} "
+                f"CCACHE_NOHASHDIR=1 {make_cmd}")
+            sh.run(f"CCACHE_DIR={config.ccache_dir} ccache --zero-stats")
+
+        logger.info(f"Running {make_cmd}")
+        cmd = sh.Command(
+            make_cmd,
+            save_output_as=(copy_log_to / 'make' if copy_log_to else None),
+            pin_to_bench_cpus=self.pin_to_bench_cpus)
         cmd.start()
         cmd.join()
 
         if copy_log_to:
-            (copy_log_to / 'make.stdout').write_bytes(cmd.stdout or b'')
-            (copy_log_to / 'make.stderr').write_bytes(cmd.stderr or b'')
             logger.info("Saved make output to %s", copy_log_to)
 
         if cmd.returncode != 0:
@@ -513,15 +611,59 @@ class BuildManager:
         # cmd error will be handled by caller
         return cmd
 
+    def _configure_key(self, configure_cmd: str) -> str:
+        """
+        Identify a configuration by the configure invocation and the git blob
+        ids of the build system sources it's generated from.
+        """
+        inputs = git.git(
+            self.repo_path,
+            "ls-files -s -- configure.ac '*.am' 'build-aux/m4/*.m4'",
+            check=True).stdout
+        return util.sha256(configure_cmd + '\n' + inputs)
+
+
+@functools.lru_cache(maxsize=None)
+def _boost_flags() -> str:
+    """Extra configure flags for finding boost; these depend only on the host."""
+    armlib_path = '/usr/lib/arm-linux-gnueabihf/'
+
+    if Path(armlib_path).is_dir():
+        # On some architectures we need to manually specify this,
+        # otherwise configuring with clang can fail.
+        return '--with-boost-libdir=%s' % armlib_path
+    return ''
+
+
+def ccache_hit_rate() -> t.Optional[float]:
+    """
+    Return the percentage of compilations served from ccache since the stats
+    were last zeroed, or None if that's unknown.
+    """
+    ret = sh.run(f"CCACHE_DIR={config.ccache_dir} ccache --print-stats")
+    if not ret.ok:
+        return None
+
+    stats = {}
+    for line in ret.stdout.splitlines():
+        name, _, val = line.partition('\t')
+        if val.strip().isdigit():
+            stats[name] = int(val)
+
+    hits = stats.get('direct_cache_hit', 0) + stats.get('preprocessed_cache_hit', 0)
+    total = hits + stats.get('cache_miss', 0)
+    return (100.0 * hits / total) if total else None
+
 
 class BuildCache:
     """
     Utility for caching built bitcoin binaries. This allows us to switch back
     and forth between benchmark targets without having to rebuild.
     """
-    def __init__(self, workdir: Path, compiler: config.Compilers, cachedir: Path = None):
+    def __init__(self, workdir: Path, compiler: config.Compilers, cachedir: Path = None,
+                 repo_path: Path = None):
         self.workdir = workdir
-        self.repo_path = workdir / 'bitcoin'
+        self.repo_path = repo_path or workdir / 'bitcoin'
         self.cachedir = cachedir or (workdir / 'build-cache')
         self.cachedir.mkdir(exist_ok=True)
 
@@ -534,9 +676,11 @@ class BuildCache:
     def save(self, target: config.Target):
         cache = self._get_cache_path(target)
         logger.info("Copying build to cache %s", cache)
-        starttime = time.time()
-        shutil.copytree(self.repo_path, cache)
-        logger.info("Cached build %s in %.2fs", cache, time.time() - starttime)
+        starttime = time.perf_counter()
+        # Leave out .git: in a worktree it's a pointer into this run's clone,
+        # which won't exist by the time the cache is restored.
+        sh.copytree(self.repo_path, cache, exclude={'.git'})
+        logger.info("Cached build %s in %.2fs", cache, time.perf_counter() - starttime)
 
     def restore(self, target: config.Target) -> bool:
         """
@@ -557,9 +701,12 @@ class BuildCache:
             "Cached version of build %s found - "
             "restoring from that and skipping build ", target.cache_key(self.compiler))
 
+        # Replace everything but the checkout's own .git with the cached tree.
         sh.cd(self.workdir)
-        sh.rm(self.repo_path)
-        shutil.copytree(cache, self.repo_path)
+        for entry in self.repo_path.iterdir():
+            if entry.name != '.git':
+                sh.rm(entry)
+        sh.copytree(cache, self.repo_path, exclude={'.git'})
         _assert_version(self.repo_path, target.gitco)
         sh.cd(self.repo_path)
         return True
@@ -2,36 +2,43 @@ import socket
 import os
 import random
 import datetime
-import multiprocessing
+import functools
 import re
 from typing import Optional as Op
 import typing as t
 from typing_extensions import Annotated
-from typing import TYPE_CHECKING
+from dataclasses import dataclass
 from enum import Enum
 from pathlib import Path
 
 import yaml
-from pydantic import BaseModel, validator, PositiveInt, AfterValidator
+from pydantic import (
+    BaseModel, Field, validator, PositiveInt, NonNegativeInt, AfterValidator)
 
-if TYPE_CHECKING:
-    from dataclasses import dataclass
-else:
-    from pydantic.dataclasses import dataclass
+try:
+    # Use the libyaml-backed loader when PyYAML was built with it.
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader  # type: ignore
 
 from . import logging, util
 
 logger = logging.get_logger()
 
-# Get physical memory specs
-MEM_GIB = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / (1024.0**3)
-
 # If set, do extremely granular logging of RPC calls.
 LOG_TRACE = bool(os.environ.get('BITCOINPERF_TRACE'))
 
-DEFAULT_NPROC = max(1, int(multiprocessing.cpu_count()) - 1)
 
-HOSTNAME = socket.gethostname()
+@functools.lru_cache(maxsize=1)
+def default_nproc() -> int:
+    return max(1, (os.cpu_count() or 1) - 1)
+
+
+@functools.lru_cache(maxsize=1)
+def hostname() -> str:
+    return socket.gethostname()
+
+
 BENCH_NAMES = {
     "gitclone",
     "build",
@@ -42,13 +49,10 @@ BENCH_NAMES = {
     "reindex",
 }
 
-# TODO shoulddn't be creating files on import
 config_path = Path.home() / ".bitcoinperf"
-config_path.mkdir(exist_ok=True)
 
 # Where run data is kept; this used to be under /tmp/bitcoinperf-*.
 workdir_path = config_path / "runs"
-workdir_path.mkdir(exist_ok=True)
 
 # Where the synced peer optionally resides.
 peer_path = config_path / "peer"
@@ -56,6 +60,14 @@ peer_repo = peer_path / "bitcoin"
 peer_datadir = peer_path / "datadir"
 base_datadirs = config_path / "base_datadirs"
 
+# Compiler cache shared by builds with `use_ccache` set.
+ccache_dir = config_path / "ccache"
+
+
+def ensure_config_dirs():
+    """Create the bitcoinperf home and runs directories if need be."""
+    workdir_path.mkdir(parents=True, exist_ok=True)
+
 
 @dataclass
 class PrunedDatadir:
@@ -99,7 +111,7 @@ class Compilers(str, Enum):
     gcc = "gcc"
 
 
-@dataclass
+@dataclass(frozen=True)
 class GitCheckout:
     # e.g. "HEAD"
     ref: str
@@ -125,8 +137,17 @@ def is_writeable_path(p: str):
     return Path(p)
 
 
+def _has_entries(path: Path, names: t.Set[str]) -> bool:
+    """True if the directory at `path` contains all of `names`."""
+    try:
+        with os.scandir(path) as it:
+            return names.issubset(e.name for e in it)
+    except (FileNotFoundError, NotADirectoryError):
+        return False
+
+
 def is_datadir(path: Path):
-    if not ((path / "blocks").exists() and (path / "chainstate").exists()):
+    if not _has_entries(path, {"blocks", "chainstate"}):
         raise ValueError("path isn't a valid datadir")
     return path
 
@@ -138,8 +159,7 @@ def path_exists(path: Path):
 
 
 def is_built_bitcoin(path: Path):
-    if not ((path / "src" / "bitcoind").exists() and
-            (path / "src" / "bitcoin-cli").exists()):
+    if not _has_entries(path / "src", {"bitcoind", "bitcoin-cli"}):
         raise ValueError("path doesn't have bitcoin binaries")
     return path
 
@@ -150,17 +170,23 @@ def is_compiler(name):
     return name
 
 
+# How long to wait on a peer before considering it unreachable.
+PORT_CHECK_TIMEOUT_SECS = 2.0
+
+
 def is_port_open(addr: str) -> str:
-    hostname, port = addr, "8333"
-    if ":" in addr:
-        hostname, port = addr.split(":")
+    hostname, sep, port = addr.rpartition(":")
+    if not sep:
+        hostname, port = addr, "8333"
+
+    if not port.isdigit():
+        raise ValueError("invalid port in node address {}".format(addr))
 
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     try:
-        s.connect((hostname, int(port)))
-        s.shutdown(2)
-        return addr
-    except Exception:
+        with socket.create_connection(
+                (hostname, int(port)), timeout=PORT_CHECK_TIMEOUT_SECS):
+            return addr
+    except OSError:
         raise ValueError("can't connect to node at {}".format(addr))
 
 
@@ -176,18 +202,39 @@ def _expandvars(s: str):
 
 EnvStr = Annotated[str, AfterValidator(_expandvars)]
 
-ExistingDatadir = Annotated[
-    Path,
-    AfterValidator(is_valid_path),
-    AfterValidator(path_exists),
-    AfterValidator(is_datadir),
-]
+_UNEXPANDED_VAR_RE = re.compile(r"\$\{?\w+\}?")
+
+
+def is_set(s: str):
+    # expandvars leaves references to unset variables as-is, so catch those
+    # here rather than failing later on, e.g., an HTTP request.
+    if not s or _UNEXPANDED_VAR_RE.fullmatch(s):
+        raise ValueError("value is empty or references an unset variable")
+    return s
+
+
+# Each of the following types uses a single validator which composes the
+# checks above, rather than one AfterValidator per check, so that pydantic
+# only has to run one function per field.
+
+def _is_set_envstr(s: str):
+    return is_set(_expandvars(s))
+
+
+def _is_repodir(p: Path):
+    return path_exists(is_valid_path(p))
+
+
+def _is_existing_datadir(p: Path):
+    return is_datadir(_is_repodir(p))
 
-RepoDir = Annotated[
-    Path,
-    AfterValidator(is_valid_path),
-    AfterValidator(path_exists),
-]
+
+# An EnvStr that must resolve to something non-empty.
+RequiredEnvStr = Annotated[str, AfterValidator(_is_set_envstr)]
+
+ExistingDatadir = Annotated[Path, AfterValidator(_is_existing_datadir)]
+
+RepoDir = Annotated[Path, AfterValidator(_is_repodir)]
 
 WriteablePath = Annotated[Path, AfterValidator(is_writeable_path)]
 
@@ -221,13 +268,13 @@ def get_envname():
         "bench-hdd-1": "ccl-bench-hdd-1",
         "bench-ssd-1": "ccl-bench-ssd-1",
         "bench-ssd-6": "ccl-bench-ssd-6",
-    }.get(HOSTNAME, "")
+    }.get(hostname(), "")
 
 
 class Codespeed(BaseModel):
-    url: EnvStr
-    username: EnvStr
-    password: EnvStr
+    url: RequiredEnvStr
+    username: RequiredEnvStr
+    password: RequiredEnvStr
     envname: Op[EnvStr] = None
 
     @validator("envname", always=True)
@@ -241,16 +288,21 @@ class Bench(BaseModel):
 
 
 class BenchBuild(Bench):
-    num_jobs: Op[PositiveInt] = PositiveInt(DEFAULT_NPROC)
+    num_jobs: Op[PositiveInt] = Field(default_factory=default_nproc)
     configure_args: EnvStr = EnvStr("")
 
+    # Build with ccache. Much faster when sweeping over many commits, but the
+    # build times aren't comparable to cold builds, so they're reported under
+    # a separate name.
+    use_ccache: bool = False
+
 
 class BenchUnittests(Bench):
-    num_jobs: Op[PositiveInt] = PositiveInt(DEFAULT_NPROC)
+    num_jobs: Op[PositiveInt] = Field(default_factory=default_nproc)
 
 
 class BenchFunctests(Bench):
-    num_jobs: Op[PositiveInt] = PositiveInt(DEFAULT_NPROC)
+    num_jobs: Op[PositiveInt] = Field(default_factory=default_nproc)
 
 
 class BenchMicrobench(Bench):
@@ -312,6 +364,10 @@ class Benches(BaseModel):
     reindex_chainstate: Op[BenchReindexChainstate] = None
 
 
+_NON_ALNUM_RE = re.compile(r"[^0-9a-zA-Z]")
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
 class Target(BaseModel):
     """
     Data that uniquely identifies a bitcoin configuration to benchmark.
@@ -322,6 +378,10 @@ class Target(BaseModel):
     bitcoind_extra_args: EnvStr = EnvStr("")
     configure_args: EnvStr = EnvStr("")
 
+    # Extra environment variables for bitcoind, e.g. `MALLOC_ARENA_MAX: "1"`
+    # to compare glibc's per-thread malloc arenas against a single one.
+    bitcoind_env: t.Dict[str, EnvStr] = {}
+
     # Used for display in output.
     name: Op[EnvStr] = None
 
@@ -332,22 +392,36 @@ class Target(BaseModel):
     # commit.
     gitco: Op[GitCheckout] = None
 
+    # A working directory dedicated to this target's commit; see
+    # `git.add_worktree()`. If unset, the shared clone is used.
+    worktree: Op[Path] = None
+
     def cache_key(self, compiler: Compilers):
         """
-        A unique, shortish identifier suitable for use as an ID in a cache.
+        A unique, shortish identifier suitable for use as an ID in a build cache.
 
-        TODO unittest this
+        Only what affects the build goes into the key, so targets that differ
+        only in, e.g., their bitcoind_extra_args share a cached build.
         """
-        sha = util.sha256(self._hash_str + str(compiler))
-        ref = re.sub("[^0-9a-zA-Z]", "-", self.gitref[:16])
+        if not self.gitco:
+            raise ValueError(
+                "can't generate cache key until git checkout is resolved")
+        sha = util.sha256(
+            "{}|{}|{}".format(self.gitco.sha, self.configure_args, compiler))
+        ref = _NON_ALNUM_RE.sub("-", self.gitref[:16])
         return f"{ref}-{sha[:16]}"
 
-    @property
+    @functools.cached_property
     def id(self):
         """A short, human-readable ID."""
-        return "{}-{}".format(
+        id_ = "{}-{}".format(
             self.gitref,
-            re.sub(r"\s+", "", self.bitcoind_extra_args).replace("-", ""))
+            _WHITESPACE_RE.sub("", self.bitcoind_extra_args).replace("-", ""))
+        if self.bitcoind_env:
+            # Keep targets that differ only in environment apart.
+            env = sorted(self.bitcoind_env.items())
+            id_ += "-env" + util.sha256(repr(env))[:8]
+        return id_
 
     @validator("name", always=True)
     def make_name(cls, v, values, **kwargs):
@@ -355,16 +429,14 @@ class Target(BaseModel):
             return values["gitref"]
         return v
 
-    @property
-    def _hash_str(self):
-        if not self.gitco:
-            raise ValueError(
-                "can't generate cache key until git checkout is resolved")
-        return (self.gitco.sha + self.gitremote + self.bitcoind_extra_args +
-                self.name + self.configure_args + str(self.rebase))
-
     def __hash__(self):
-        return hash(self._hash_str)
+        if not self.gitco:
+            raise ValueError("can't hash target until git checkout is resolved")
+        # Hash a tuple so that we reuse each string's cached hash instead of
+        # building and hashing a new string each time.
+        return hash((self.gitco.sha, self.gitremote, self.bitcoind_extra_args,
+                     self.name, self.configure_args, self.rebase,
+                     tuple(sorted(self.bitcoind_env.items()))))
 
 
 class Slack(BaseModel):
@@ -386,6 +458,20 @@ class Config(BaseModel):
     codespeed: Op[Codespeed] = None
     benches: Op[Benches] = None
 
+    # If set, pin benchmarked processes to these CPUs and keep the runner
+    # (and anything else it spawns) off of them. Best paired with isolcpus=.
+    bench_cpus: Op[t.List[NonNegativeInt]] = None
+
+    # Skip fetching a git remote that was fetched less than this many seconds
+    # ago. Set to 0 to always fetch, e.g. to pick up a branch that just moved.
+    fetch_ttl_secs: NonNegativeInt = 5 * 60
+
+    # Build targets in worktrees on a tmpfs of up to this many GiB, if there's
+    # enough free memory for it. Node datadirs stay on disk regardless. The
+    # tmpfs is unmounted at exit, so its build trees don't outlive the run
+    # even with teardown disabled.
+    worktrees_tmpfs_gib: Op[PositiveInt] = None
+
     def __init__(self, **data):
         super().__init__(**data)
 
@@ -398,10 +484,10 @@ class Config(BaseModel):
     @validator("workdir", pre=True, always=True)
     def mk_workdir(cls, v):
         if not v:
-            now = datetime.datetime.utcnow().isoformat().split(".")[0].replace(
-                ":", "")
+            now = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H%M%S")
             rand = util.sha256(str(random.random()))[:8]
             name = f"{now}-{rand}"
+            ensure_config_dirs()
             path = Path(workdir_path / name)
             path.mkdir()
             return path
@@ -417,6 +503,7 @@ class Config(BaseModel):
         return v
 
     def bitcoinperf_home_path(self):
+        ensure_config_dirs()
         return config_path
 
     def build_cache_path(self):
@@ -431,15 +518,25 @@ class Config(BaseModel):
         return d
 
 
+# Configs are typically a few KB; anything this large is probably a mistake.
+LARGE_CONFIG_BYTES = 1_000_000
+
+
 def load(content: t.Union[Path, str]) -> Config:
     if isinstance(content, Path):
         content = content.read_text()
 
-    return Config(**yaml.load(content, Loader=yaml.Loader))
+    if len(content) > LARGE_CONFIG_BYTES:
+        logger.warning(
+            "config is unusually large (%d bytes); parsing may be slow",
+            len(content))
+
+    return Config.model_validate(yaml.load(content, Loader=YamlLoader))
 
 
 def link_latest_run(conf: Config):
     """Symlink a shortcut to the latest run."""
+    ensure_config_dirs()
     latest = workdir_path / "latest"
     latest.unlink(missing_ok=True)
     assert conf.workdir
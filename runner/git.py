@@ -1,4 +1,7 @@
-import shutil
+import functools
+import os
+import shlex
+import time
 import typing as t
 from pathlib import Path
 
@@ -12,66 +15,88 @@ logger = get_logger()
 
 BITCOIN_URL_TEMPLATE = 'https://github.com/{}/bitcoin.git'
 
+# Clone only commits and trees up front; git fetches the blobs needed for a
+# checkout, rebase, etc. on demand. Unlike a shallow clone this keeps full
+# history, so merge-bases and rebases still work.
+PARTIAL_CLONE_ARGS = '--filter=blob:none'
 
-def git_cache_path():
-    p = config.config_path / 'bitcoin.cached.git'
-    p.mkdir(exist_ok=True, parents=True)
-    return p
 
+def git(repo_path: Path, args: str, **kwargs) -> sh.RunReturn:
+    """Run a git command against a repo without changing directory."""
+    return sh.run(['git', '-C', str(repo_path), *shlex.split(args)], **kwargs)
 
-def cache_repo():
+
+def git_cache_path() -> Path:
+    return config.config_path / 'bitcoin.cached.git'
+
+
+# Written into the cache once it has been fully cloned. Bump the version when
+# the layout of the cache changes to have existing caches recreated.
+CACHE_MARKER_NAME = '.bitcoinperf-cache-ok'
+CACHE_VERSION = '2'
+
+
+def cache_repo() -> bool:
     """Make an initial clone of the bitcoin repo to the bitcoinperf-wide cache.
 
-    The resulting repo will be used to copy from for faster "cloning."
+    The resulting repo is used as a reference for faster cloning.
+
+    Returns True if the cache is usable.
     """
     cache_path = git_cache_path()
+    marker = cache_path / CACHE_MARKER_NAME
 
-    if cache_path.exists() and (cache_path / 'autogen.sh').exists():
-        return True
-    elif cache_path.exists():
-        # Invalid repo?
+    try:
+        if marker.read_text() == CACHE_VERSION:
+            return True
+    except OSError:
+        pass
+
+    if cache_path.exists():
+        # Incomplete or outdated cache.
         sh.rm(cache_path)
 
+    config.ensure_config_dirs()
     url = BITCOIN_URL_TEMPLATE.format('bitcoin')
     logger.info("Cloning bitcoin repo from url %s", url)
-    sh.run("git clone {} {}".format(url, cache_path))
-
-    sh.cd(cache_path)
+    if not sh.run("git clone --bare {} {} {}".format(
+            PARTIAL_CLONE_ARGS, url, cache_path)).ok:
+        return False
 
-    sh.run('git fetch')
-    sh.run("git checkout origin/master")
+    marker.write_text(CACHE_VERSION)
+    return True
 
 
 def get_repo(git_path: Path, cached_okay: bool = True):
     """
     Check out the bitcoin git repo to a path if necessary, optionally
-    copying from a cache.
+    borrowing objects from a cache.
     """
-    copy_from_path = None
+    reference_path = None
 
-    if cached_okay:
-        cache_repo()
-    if cached_okay and git_cache_path().exists():
-        copy_from_path = git_cache_path()
+    if cached_okay and cache_repo():
+        reference_path = git_cache_path()
 
     if not git_path.exists():
-        if copy_from_path:
+        url = BITCOIN_URL_TEMPLATE.format('bitcoin')
+
+        if reference_path:
             logger.info(
-                "Copying bitcoin repo from local path %s", copy_from_path)
-            shutil.copytree(copy_from_path, git_path)
+                "Cloning bitcoin repo from url %s with reference %s",
+                url, reference_path)
+            sh.run("git clone {} --reference {} --dissociate {} {}".format(
+                PARTIAL_CLONE_ARGS, reference_path, url, git_path))
         else:
-            url = BITCOIN_URL_TEMPLATE.format('bitcoin')
             logger.info("Cloning bitcoin repo from url %s", url)
-            sh.run("git clone {} {}".format(url, git_path))
+            sh.run("git clone {} {} {}".format(PARTIAL_CLONE_ARGS, url, git_path))
 
-    sh.cd(git_path)
-    sh.run('git fetch --all')
-    sh.run("git checkout origin/master")
+    # Fetching and checking out are left to `resolve_targets()`, which only
+    # fetches the remotes that are actually needed.
 
 
 def checkout_in_dir(git_path: Path, target: config.Target) -> GitCheckout:
     """
-    Given a path to a repository, cd to it and checkout a specific ref.
+    Given a path to a repository, checkout a specific ref in it.
 
     Incoming targets should have been fully resolved by calling
     `resolve_targets()` beforehand - they should have valid `.gitco` objects
@@ -79,7 +104,11 @@ def checkout_in_dir(git_path: Path, target: config.Target) -> GitCheckout:
     """
     assert target.gitco, 'Target must be resolved before checking out.'
     co = target.gitco
-    checkoutcmd = sh.run(f"git checkout {co.sha}")
+    if read_head_sha(git_path) == co.sha:
+        logger.info("Already at {}".format(co))
+        return co
+
+    checkoutcmd = git(git_path, f"checkout {co.sha}")
     if checkoutcmd.returncode != 0:
         logger.warning(f"git checkout of {co.sha} failed: {checkoutcmd.output}")
         raise RuntimeError(f"sha {co.sha} was not valid in {git_path}")
@@ -87,13 +116,52 @@ def checkout_in_dir(git_path: Path, target: config.Target) -> GitCheckout:
     return co
 
 
+def add_worktree(repo_path: Path, gitco: GitCheckout) -> Path:
+    """
+    Return a worktree of `repo_path` checked out at `gitco`, creating it if
+    need be.
+
+    Each commit gets its own working directory, so build products from one
+    target aren't clobbered by checking out the next.
+    """
+    path = repo_path.parent / 'worktrees' / gitco.sha[:12]
+    if path.is_dir():
+        return path
+
+    git(repo_path, f"worktree add --detach {path} {gitco.sha}", check=True)
+    logger.info("Created worktree for %s at %s", gitco, path)
+    return path
+
+
+# By default, don't refetch a remote into the same repo if it was fetched this
+# recently; see `Config.fetch_ttl_secs`.
+FETCH_TTL_SECS = 5 * 60
+
+
+def _fetch_marker(repo_path: Path, remote: str) -> Path:
+    return repo_path / '.git' / f'bitcoinperf-fetched-{remote}'
+
+
+def _fetched_recently(repo_path: Path, remote: str, ttl_secs: float) -> bool:
+    try:
+        mtime = _fetch_marker(repo_path, remote).stat().st_mtime
+    except FileNotFoundError:
+        return False
+    return time.time() - mtime < ttl_secs
+
+
+def _mark_fetched(repo_path: Path, remote: str):
+    _fetch_marker(repo_path, remote).touch()
+
+
 # When given, find the merge-base in origin/master relative to the other
 # target.
 MERGEBASE_REF = '$mergebase'
 
 
 def resolve_targets(repo_path: Path,
-                    targets: t.List[config.Target]
+                    targets: t.List[config.Target],
+                    fetch_ttl_secs: float = FETCH_TTL_SECS,
                     ) -> t.Tuple[t.List[GitCheckout], t.List[config.Target]]:
     """
     Intake targets and resolve each to a specific commit hash.
@@ -103,20 +171,32 @@ def resolve_targets(repo_path: Path,
 
     This should be called once before any checking out is done.
 
+    Remotes fetched within the last `fetch_ttl_secs` aren't fetched again;
+    pass 0 to always fetch.
+
     DESTRUCTIVE: attaches the new checkout objects to the targets passed in
         (`Target.gitco`).
 
     Returns:
         (list of checkouts, list of targets that failed to check out).
     """
+    # Paths are used after the chdir below, so make sure they're absolute.
+    repo_path = repo_path.resolve()
+
     if not repo_path.exists():
         get_repo(repo_path)
 
     sh.cd(repo_path)
 
-    remotes = {
-        i.split()[0] for i in
-        sh.run('git remote -v').stdout.splitlines()}
+    remotes = set(sh.run(['git', 'remote']).stdout.split())
+
+    def fetch_remote(name):
+        if _fetched_recently(repo_path, name, fetch_ttl_secs):
+            logger.debug("skipping fetch of %s; fetched recently", name)
+            return
+        if sh.run(f'git fetch --force {name} --tags').ok:
+            _mark_fetched(repo_path, name)
+        clear_git_cache()
 
     def get_remote(name):
         if name == 'origin':
@@ -124,15 +204,18 @@ def resolve_targets(repo_path: Path,
         if name not in remotes:
             url = BITCOIN_URL_TEMPLATE.format(name)
             sh.run(f'git remote add {name} {url}')
-        sh.run(f'git fetch --force {name} --tags')
+        fetch_remote(name)
 
     if 'origin' not in remotes:
         sh.run('git remote add origin https://github.com/bitcoin/bitcoin.git')
 
-    sh.run("git fetch origin --force --tags")
+    fetch_remote('origin')
 
-    # Clear any local modifications.
-    sh.run("git reset --hard origin/master")
+    # Clear any local modifications. Skip the reset when the tree is already
+    # clean since each target gets checked out explicitly below anyway.
+    status = sh.run(['git', 'status', '--porcelain', '--untracked-files=no'])
+    if status.stdout.strip():
+        sh.run("git reset --hard origin/master")
 
     for remote in {tar.gitremote for tar in targets}:
         get_remote(remote)
@@ -140,13 +223,26 @@ def resolve_targets(repo_path: Path,
     mergebase = [t for t in targets if MERGEBASE_REF in [t.name, t.gitref]]
     normal_refs = [t for t in targets if MERGEBASE_REF not in [t.name, t.gitref]]
 
+    # Fetch all requested PRs with one `git fetch` per remote.
+    pr_refspecs: t.Dict[str, t.List[str]] = {}
+
     for tar in normal_refs:
         if not tar.gitref.startswith('pr/'):
             continue
 
         num = tar.gitref.split('pr/')[-1]
-        sh.run(f"git fetch --force {tar.gitremote} "
-               f"pull/{num}/head:refs/remotes/{tar.gitremote}/pr/{num}")
+        pr_refspecs.setdefault(tar.gitremote, []).append(
+            f"pull/{num}/head:refs/remotes/{tar.gitremote}/pr/{num}")
+
+    for remote, refspecs in pr_refspecs.items():
+        if not sh.run(f"git fetch --force {remote} {' '.join(refspecs)}").ok:
+            # One bad PR number fails the whole fetch; retry individually so
+            # that only the bad targets go unresolved.
+            for refspec in refspecs:
+                sh.run(f"git fetch --force {remote} {refspec}")
+
+    if pr_refspecs:
+        clear_git_cache()
 
     bad_targets = []
     checkouts = []
@@ -172,32 +268,32 @@ def resolve_targets(repo_path: Path,
         checkouts.append(co)
         mergebase_target.gitco = co
 
+    # Resolve every candidate ref up front with a single git process.
+    candidate_refs = []
+    for tar in normal_refs:
+        if not is_hex(tar.gitref):
+            candidate_refs.append(f'{tar.gitremote}/{tar.gitref}')
+        candidate_refs.append(tar.gitref)
+
+    resolved = get_commit_shas(candidate_refs)
+
     # Resolve all of the non-mergebase targets into GitCheckouts.
     for tar in normal_refs:
-        ishex = is_hex(tar.gitref)
-        bad = False
         msg = ''
-        sha = ''
         pre_rebase_sha = None
 
-        if ishex:
-            sha = tar.gitref
-            bad = sh.run(f'git show {tar.gitref}').returncode != 0
+        if is_hex(tar.gitref):
+            sha = resolved.get(tar.gitref, '')
         else:
-            sha_res = sh.run(f'git rev-parse {tar.gitremote}/{tar.gitref}')
-            if not sha_res.ok:
+            sha = resolved.get(f'{tar.gitremote}/{tar.gitref}', '')
+            if not sha:
                 logger.debug(f"Couldn't parse rev {tar.gitremote}/{tar.gitref}; "
                              f"trying {tar.gitref}")
                 # Fall back to just trying the ref, no remote. Sometimes for
                 # tags this is necessary.
-                sha_res = sh.run(f'git rev-parse {tar.gitref}')
-                if not sha_res.ok:
-                    bad = True
-
-            if sha_res.ok:
-                sha = sha_res.stdout.strip()
+                sha = resolved.get(tar.gitref, '')
 
-        if bad:
+        if not sha:
             logger.warning(f'ref not found: {tar.gitref}')
             bad_targets.append(tar)
             continue
@@ -213,15 +309,17 @@ def resolve_targets(repo_path: Path,
             if not rebasecmd.ok:
                 logger.warning(
                     "rebase of %s failed:\n%s", tar.gitref, rebasecmd.output)
+                sh.run('git rebase --abort')
                 bad_targets.append(tar)
                 continue
 
             pre_rebase_sha = sha
-            sha = get_sha('HEAD')
+            sha, msg = get_head_info()
             logger.info("Rebased %s (%s) on top of origin/master (%s): %s",
                         tar.gitref, pre_rebase_sha, get_sha('origin/master'), sha)
+        else:
+            msg = get_commit_msg(sha)
 
-        msg = get_commit_msg(sha)
         co = GitCheckout(
             ref=tar.gitref,
             remote=tar.gitremote,
@@ -236,20 +334,119 @@ def resolve_targets(repo_path: Path,
     return checkouts, bad_targets
 
 
+def _read_ref(gitdir: Path, ref: str) -> t.Optional[str]:
+    """Resolve a ref like refs/heads/master from loose or packed refs."""
+    # Branch refs of a worktree live in the main repo's git dir.
+    try:
+        commondir = gitdir / (gitdir / 'commondir').read_text().strip()
+    except OSError:
+        commondir = gitdir
+
+    # Per-worktree refs (e.g. HEAD) live in the worktree's own git dir, so
+    # check that first.
+    dirs = (gitdir,) if commondir == gitdir else (gitdir, commondir)
+    for dir_ in dirs:
+        try:
+            return (dir_ / ref).read_text().strip()
+        except OSError:
+            pass
+
+    try:
+        packed = (commondir / 'packed-refs').read_text()
+    except OSError:
+        return None
+
+    for line in packed.splitlines():
+        sha, _, name = line.partition(' ')
+        if name == ref:
+            return sha
+    return None
+
+
+def read_head_sha(repo_path: Path) -> t.Optional[str]:
+    """
+    Read the sha of HEAD straight out of the git directory, saving a git
+    process.
+
+    Returns None if HEAD can't be resolved this way, in which case ask git.
+    """
+    gitdir = repo_path / '.git'
+    try:
+        if gitdir.is_file():
+            # Worktrees have a .git file pointing to their real git dir.
+            gitdir = Path(gitdir.read_text().split('gitdir:', 1)[1].strip())
+        head: t.Optional[str] = (gitdir / 'HEAD').read_text().strip()
+    except (OSError, IndexError):
+        return None
+    if head and head.startswith('ref: '):
+        head = _read_ref(gitdir, head[5:])
+    return head if head and is_hex(head) else None
+
+
 def get_sha(ref: str) -> str:
-    return sh.run(f'git rev-parse {ref}', check=True).stdout.strip()
+    # HEAD moves with every checkout, so never serve it from the cache.
+    if ref == 'HEAD':
+        return (read_head_sha(Path.cwd()) or
+                _get_sha.__wrapped__(os.getcwd(), ref))
+    return _get_sha(os.getcwd(), ref)
 
 
 def get_commit_msg(ref: str) -> str:
-    return sh.run(f'git log -1 --pretty=%B {ref}', check=True).stdout.strip()
+    # Commit messages are immutable for a given sha; anything else may move.
+    if is_hex(ref):
+        return _get_commit_msg(os.getcwd(), ref)
+    return _get_commit_msg.__wrapped__(os.getcwd(), ref)
 
 
-def get_git_mergebase(repo_path: Path, remote: str, name: str) -> str:
-    sh.cd(repo_path)
+@functools.lru_cache(maxsize=128)
+def _get_sha(cwd: str, ref: str) -> str:
+    return sh.run(
+        ['git', 'rev-parse', ref], check=True, cwd=cwd).stdout.strip()
 
+
+@functools.lru_cache(maxsize=128)
+def _get_commit_msg(cwd: str, ref: str) -> str:
+    return sh.run(
+        ['git', 'log', '-1', '--pretty=%B', ref],
+        check=True, cwd=cwd).stdout.strip()
+
+
+def clear_git_cache():
+    """Forget cached ref lookups; must be called after anything moves refs."""
+    _get_sha.cache_clear()
+
+
+def get_commit_shas(refs: t.Iterable[str]) -> t.Dict[str, str]:
+    """
+    Resolve many refs to commit shas using a single git process.
+
+    Refs that don't resolve to a commit are left out of the result.
+    """
+    refs = list(dict.fromkeys(refs))
+    out = sh.run(
+        ['git', 'cat-file', '--batch-check=%(objectname) %(objecttype)'],
+        input=''.join(f'{ref}^{{commit}}\n' for ref in refs)).stdout
+
+    shas = {}
+    for ref, line in zip(refs, out.splitlines()):
+        sha, _, objtype = line.partition(' ')
+        if objtype == 'commit':
+            shas[ref] = sha
+    return shas
+
+
+def get_head_info() -> t.Tuple[str, str]:
+    """Return the sha and commit message of HEAD using a single git call."""
+    out = sh.run(
+        ['git', 'log', '-1', '--pretty=%H%x00%B', 'HEAD'], check=True).stdout
+    sha, _, msg = out.partition('\0')
+    return sha, msg.strip()
+
+
+def get_git_mergebase(repo_path: Path, remote: str, name: str) -> str:
     arg = f'{remote}/{name}' if not is_hex(name) else name
 
-    base = sh.run(f'git merge-base origin/master {arg}')
+    base = git(repo_path, f'merge-base origin/master {arg}')
     if not base.ok:
         raise ValueError(f"could not get merge-base for {arg}")
 
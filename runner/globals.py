@@ -1,30 +1,39 @@
 import typing as t
-from argparse import Namespace
 
-# A container for global state that gets set at various points during
-# a benchmark run.
-G = Namespace()
 
-# The git checkout currently being benched. Made global for easy reference
-# from the logger.
-G.gitco: 'GitCheckout' = None  # type: ignore # noqa: F821
+class _Globals:
+    """
+    A container for global state that gets set at various points during
+    a benchmark run.
+    """
+    __slots__ = (
+        'gitco', 'bench', 'benchmark', 'lockfile_held', 'slack', 'run_counts')
 
-# The current benchmark being run.
-G.bench: 'Benchmark' = None  # type: ignore # noqa: F821
+    def __init__(self):
+        # The git checkout currently being benched. Made global for easy
+        # reference from the logger.
+        self.gitco: 'GitCheckout' = None  # type: ignore # noqa: F821
 
-# The current benchmark being run.
-G.benchmark: 'Benchmark' = None  # type: ignore # noqa: F821
+        # The current benchmark being run.
+        self.bench: 'Benchmark' = None  # type: ignore # noqa: F821
 
-# Did we acquire the system-wide lockfile?
-G.lockfile_held: bool = False  # type: ignore
+        # The current benchmark being run.
+        self.benchmark: 'Benchmark' = None  # type: ignore # noqa: F821
 
-G.slack: 'SlackClient' = None  # type: ignore # noqa: F821
+        # Did we acquire the system-wide lockfile?
+        self.lockfile_held: bool = False
 
-# The number of remaining run counts:
-# {
-#   ref1: {
-#     bench1: int, bench2: int, ...
-#   },
-#   ref2: { ...  }
-# }
-G.run_counts: t.Dict['GitCheckout', t.Dict['Benchmark', int]] = {}  # type: ignore # noqa
+        self.slack: 'SlackClient' = None  # type: ignore # noqa: F821
+
+        # The number of remaining run counts:
+        # {
+        #   ref1: {
+        #     bench1: int, bench2: int, ...
+        #   },
+        #   ref2: { ...  }
+        # }
+        self.run_counts: t.Dict[
+            'GitCheckout', t.Dict['Benchmark', int]] = {}  # noqa: F821
+
+
+G = _Globals()
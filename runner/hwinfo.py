@@ -4,6 +4,7 @@ bitcoinperf.
 """
 
 import argparse
+import functools
 import os
 import platform
 import subprocess
@@ -13,6 +14,7 @@ import distro
 import re
 import sys
 import typing as t
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from .util import md_table
@@ -37,8 +39,7 @@ def get_disk_iops(locations=None):
         except Exception:
             return ''
 
-    for location in locations:
-        out[str(location)] = {'read_iops': '', 'write_iops': ''}
+    def run_fio(location):
         filename = location / 'random_read_write.fio'
 
         cmd = (
@@ -47,7 +48,25 @@ def get_disk_iops(locations=None):
             "--iodepth=64 --size=180M --time_based=1 --runtime=20 "
             "--readwrite=randrw --rwmixread=75")
 
-        res = subprocess.run(cmd.split(), capture_output=True)
+        return subprocess.run(cmd.split(), capture_output=True)
+
+    def probe_device(device_locations):
+        return [(loc, run_fio(loc)) for loc in device_locations]
+
+    # Probes on the same device would skew each other's numbers, so only
+    # run probes concurrently when they're on different devices.
+    by_device: t.Dict[int, list] = {}
+    for location in locations:
+        by_device.setdefault(Path(location).stat().st_dev, []).append(location)
+
+    with ThreadPoolExecutor(max_workers=max(len(by_device), 1)) as executor:
+        probes = [
+            probe for device_probes in executor.map(
+                probe_device, by_device.values())
+            for probe in device_probes]
+
+    for location, res in probes:
+        out[str(location)] = {'read_iops': '', 'write_iops': ''}
 
         if res.returncode != 0:
             print("Fio command (`{}`) failed ({}): {}".format(
@@ -63,6 +82,7 @@ def get_disk_iops(locations=None):
     return out
 
 
+@functools.lru_cache(maxsize=1)
 def get_processor_name():
     """
     Lifted from StackOverflow: https://stackoverflow.com/a/13078519
@@ -70,19 +90,23 @@ def get_processor_name():
     if _SYS == "Windows":
         return platform.processor()
     elif _SYS == "Darwin":
-        os.environ['PATH'] += os.pathsep + '/usr/sbin'
         return subprocess.check_output(
-            "sysctl -n machdep.cpu.brand_string").strip()
+            ["/usr/sbin/sysctl", "-n", "machdep.cpu.brand_string"],
+            text=True).strip()
     elif _SYS == "Linux":
-        for line in open('/proc/cpuinfo', 'r').readlines():
-            if "model name" in line:
-                return line.split(':', 1)[-1].strip()
+        # The first CPU's stanza has what we need, so stop reading there
+        # rather than loading an entry for every core.
+        with open('/proc/cpuinfo', 'r') as f:
+            for line in f:
+                if "model name" in line:
+                    return line.split(':', 1)[-1].strip()
     return ""
 
 
-def get_hwinfo(datadir_path: Path, srcdir_path: t.Optional[str]):
-    paths_for_io = [Path(datadir_path or os.getcwd())]
-    out_dict = dict(
+@functools.lru_cache(maxsize=1)
+def _get_static_hwinfo() -> dict:
+    """Hardware details that can't change during the life of the process."""
+    return dict(
         hostname=socket.gethostname(),
         cpu_model_name=get_processor_name(),
         cpu_count=psutil.cpu_count(),
@@ -90,6 +114,13 @@ def get_hwinfo(datadir_path: Path, srcdir_path: t.Optional[str]):
         os=list(distro.linux_distribution()),
         arch=platform.machine(),
         kernel=platform.uname().release,
+    )
+
+
+def get_hwinfo(datadir_path: Path, srcdir_path: t.Optional[str]):
+    paths_for_io = [Path(datadir_path or os.getcwd())]
+    out_dict = dict(
+        _get_static_hwinfo(),
         disk=get_disk_iops(paths_for_io),
     )
 
@@ -114,31 +145,33 @@ def parse_configure_log(src_dir_path: t.Union[str, Path]) -> dict:
     if not configlog.is_file():
         print("No config.log found at %s", configlog)
 
-    lines = configlog.read_text().splitlines()
-
     def extract_val(line) -> str:
         return line.split('=', 1)[-1].replace("'", '')
 
-    for line in lines:
-        if line.startswith("  $") and 'configure ' in line:
-            out['configure_command'] = line.strip('  $')
+    # Stream the file rather than reading it whole; config.log can be large.
+    with configlog.open() as f:
+        for line in f:
+            line = line.rstrip('\n')
+
+            if line.startswith("  $") and 'configure ' in line:
+                out['configure_command'] = line.strip('  $')
 
-        elif line.startswith('clang version'):
-            out['clang_version'] = line
+            elif line.startswith('clang version'):
+                out['clang_version'] = line
 
-        elif line.startswith('g++ '):
-            out['gcc_version'] = line
+            elif line.startswith('g++ '):
+                out['gcc_version'] = line
 
-        elif line.startswith('CXX='):
-            out['cxx'] = extract_val(line)
+            elif line.startswith('CXX='):
+                out['cxx'] = extract_val(line)
 
-        elif line.startswith('CXXFLAGS='):
-            out['cxxflags'] += extract_val(line)
+            elif line.startswith('CXXFLAGS='):
+                out['cxxflags'] += extract_val(line)
 
-        elif '_CXXFLAGS=' in line:
-            val = extract_val(line)
-            if val:
-                out['cxxflags'] += val + ' '
+            elif '_CXXFLAGS=' in line:
+                val = extract_val(line)
+                if val:
+                    out['cxxflags'] += val + ' '
 
     for key in ('cxx', 'configure_command', 'cxxflags'):
         out[key] = '`' + out[key].strip() + '`'
@@ -1,5 +1,7 @@
+import atexit
 import logging
 import logging.handlers
+import queue
 import sys
 from pathlib import Path
 
@@ -17,11 +19,26 @@ def configure_logger(workdir: Path, log_level: str = 'INFO'):
     file_log_fmt = '%(asctime)s %(name)s [%(levelname)s] %(message)s'
     filehandler.setFormatter(logging.Formatter(file_log_fmt))
 
-    logger.addHandler(sh)
-    logger.addHandler(filehandler)
+    add_queued_handlers(logger, sh, filehandler)
     logger.setLevel(logging.DEBUG)
     return logger
 
 
+def add_queued_handlers(logger: logging.Logger, *handlers: logging.Handler):
+    """
+    Attach handlers to a logger behind a queue so that logging calls don't
+    block on I/O; the handlers themselves are run from a background thread.
+
+    Queued records are flushed when the interpreter exits.
+    """
+    q: queue.Queue = queue.Queue()
+    listener = logging.handlers.QueueListener(
+        q, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    logger.addHandler(logging.handlers.QueueHandler(q))
+    return listener
+
+
 def get_logger():
     return logging.getLogger('bitcoinperf')
@@ -5,6 +5,7 @@ Run a series of benchmarks against a particular Bitcoin Core revision(s).
 
 """
 import atexit
+import fcntl
 import os
 import datetime
 import getpass
@@ -18,6 +19,7 @@ from pathlib import Path
 from textwrap import dedent
 
 import clii
+import psutil
 
 from . import (
     output,
@@ -48,28 +50,23 @@ def _startup_assertions(cfg):
     """
     Ensure the benchmark environment is suitable in various ways.
     """
-    if sh.run("$(which time) -f %M sleep 0.01", quiet=True).returncode != 0:
-        raise RuntimeError("the time package is required")
-
     def warn(msg):
         if cfg.safety_checks:
             raise RuntimeError(msg)
         else:
             logger.warning(msg)
 
-    if (
-        sh.run("pgrep --list-name bitcoin | grep -v bitcoinperf", quiet=True).returncode
-        == 0
-    ):
+    if _other_bitcoin_running():
         warn(
             "benchmarks shouldn't run concurrently with unrelated bitcoin processes"
         )
 
     if cfg.safety_checks:
-        sh.run("sudo -n swapoff -a")
+        sh.run(["sudo", "-n", "swapoff", "-a"])
 
-    if sh.run('cat /proc/swaps | grep -v "^Filename"', check=False).returncode != 1:
-        warn("swap should be disabled during benchmarking")
+    with open("/proc/swaps") as f:
+        if any(not line.startswith("Filename") for line in f):
+            warn("swap should be disabled during benchmarking")
 
     avg, _, _ = os.getloadavg()
     load_tries = 10
@@ -89,14 +86,51 @@ def _startup_assertions(cfg):
         raise RuntimeError("Couldn't acquire lockfile %s; exiting", LOCKFILE_PATH)
 
 
+def _other_bitcoin_running() -> bool:
+    """Is some bitcoin process (other than bitcoinperf itself) running?"""
+    for proc in psutil.process_iter(["name"]):
+        name = proc.info["name"] or ""
+        if "bitcoin" in name and "bitcoinperf" not in name:
+            return True
+    return False
+
+
+# How many of the most recent run directories to keep around.
+KEEP_RUN_DIRS = 4
+
+# Functional test runner tmpdirs older than this are removed.
+TEST_RUNNER_TMPDIR_MAX_AGE_SECS = 3 * 24 * 60 * 60
+
+
 def _cleanup_tmpfiles():
-    """Remove temporary bitcoinperf directories older than 2 days."""
+    """
+    Remove all but the most recent bitcoinperf run directories, along with
+    stale functional test tmpdirs.
+    """
     # TODO parameterize this
-    sh.run(
-        r"ls -t1 %s | tail -n +5 | xargs -I {} rm -rf %s/{} \;"
-        % (config.workdir_path, config.workdir_path)
-    )
-    sh.run(r"find /tmp/test_runner_* -mtime +3 -exec rm -rf {} \;")
+    # The runs dir won't exist yet if every run so far had `workdir` set.
+    config.ensure_config_dirs()
+    runs = []
+    for entry in os.scandir(config.workdir_path):
+        try:
+            runs.append((entry.stat(follow_symlinks=False).st_mtime, entry.path))
+        except OSError:
+            # Removed since it was listed.
+            continue
+    runs.sort(reverse=True)
+    for _, path in runs[KEEP_RUN_DIRS:]:
+        sh.rmtree(Path(path))
+
+    cutoff = time.time() - TEST_RUNNER_TMPDIR_MAX_AGE_SECS
+    for entry in os.scandir("/tmp"):
+        if not entry.name.startswith("test_runner_"):
+            continue
+        # Other processes' tmpdirs may disappear out from under us.
+        try:
+            if entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                sh.rmtree(Path(entry.path))
+        except OSError:
+            logger.debug("couldn't clean up %s", entry.path, exc_info=True)
 
 
 def run_full_suite(cfg) -> bool:
@@ -117,7 +151,8 @@ def run_full_suite(cfg) -> bool:
     _startup_assertions(cfg)
     repodir = cfg.workdir / "bitcoin"
     git.get_repo(repodir)
-    checkouts, bad_targets = git.resolve_targets(repodir, cfg.to_bench)
+    checkouts, bad_targets = git.resolve_targets(
+        repodir, cfg.to_bench, fetch_ttl_secs=cfg.fetch_ttl_secs)
 
     if bad_targets:
         logger.warning("Couldn't resolve git targets: %s", bad_targets)
@@ -125,6 +160,15 @@ def run_full_suite(cfg) -> bool:
 
     config.link_latest_run(cfg)
 
+    if cfg.worktrees_tmpfs_gib:
+        _mount_tmpfs(cfg.workdir / "worktrees", cfg.worktrees_tmpfs_gib)
+
+    # Give each target its own worktree so that switching between them doesn't
+    # throw away the previous target's build.
+    for target in cfg.to_bench:
+        assert target.gitco
+        target.worktree = git.add_worktree(repodir, target.gitco)
+
     for target in cfg.to_bench:
         assert target.gitco
         G.gitco = target.gitco
@@ -151,6 +195,17 @@ def run_full_suite(cfg) -> bool:
                 target, cfg, compiler, cfg.benches.microbench, benchmarks.Microbench
             )
 
+        bitcoind_benches = [
+            cfg.benches.ibd_from_network,
+            cfg.benches.ibd_from_local,
+            cfg.benches.ibd_range_from_local,
+            cfg.benches.reindex,
+            cfg.benches.reindex_chainstate,
+        ]
+
+        if not any(bitcoind_benches):
+            continue
+
         compiler = config.Compilers.gcc
 
         # Only do the following for gcc (since they're expensive)
@@ -188,6 +243,54 @@ def run_full_suite(cfg) -> bool:
     return True
 
 
+def _is_tmpfs(path: Path) -> bool:
+    return any(
+        part.mountpoint == str(path.resolve()) and part.fstype == "tmpfs"
+        for part in psutil.disk_partitions(all=True))
+
+
+# tmpfs mounts made by this run; see `_unmount_tmpfs()`.
+_tmpfs_mounts: t.List[Path] = []
+
+
+def _mount_tmpfs(path: Path, size_gib: int) -> bool:
+    """
+    Mount a tmpfs at `path` if there's enough memory available for it to fill
+    up. Returns whether `path` is on a tmpfs.
+    """
+    path.mkdir(exist_ok=True)
+    if _is_tmpfs(path):
+        return True
+
+    available_gib = psutil.virtual_memory().available / (1024 ** 3)
+    if available_gib < size_gib:
+        logger.warning(
+            "not enough memory for a %dG tmpfs (%.1fG available); using disk",
+            size_gib, available_gib)
+        return False
+
+    if not sh.run(["sudo", "-n", "mount", "-t", "tmpfs", "-o",
+                   f"size={size_gib}G", "tmpfs", str(path)]).ok:
+        logger.warning("couldn't mount a tmpfs at %s; using disk", path)
+        return False
+
+    logger.info("Mounted a %dG tmpfs at %s", size_gib, path)
+    _tmpfs_mounts.append(path)
+    return True
+
+
+def _unmount_tmpfs():
+    """Unmount any tmpfs this run mounted, freeing the memory it holds."""
+    while _tmpfs_mounts:
+        path = _tmpfs_mounts.pop()
+        # We can't unmount a directory we're inside of.
+        sh.cd(path.parent)
+        if sh.run(["sudo", "-n", "umount", str(path)]).ok:
+            logger.info("Unmounted tmpfs at %s", path)
+        else:
+            logger.warning("couldn't unmount tmpfs at %s", path)
+
+
 def maybe_run_bench_some_times(
     target, cfg, compiler, bench_cfg, bench_class, *, always_run=False
 ):
@@ -203,27 +306,65 @@ def maybe_run_bench_some_times(
         b.run(cfg, bench_cfg)
 
 
+# Held open for as long as we hold the lock.
+_lockfile_fd: t.Optional[int] = None
+
+
 def _try_acquire_lockfile():
-    if LOCKFILE_PATH.exists():
+    """
+    Take an exclusive flock on the lockfile. The kernel releases it if we die,
+    so a crashed run can't leave a stale lock behind.
+    """
+    global _lockfile_fd
+
+    try:
+        fd = os.open(LOCKFILE_PATH, os.O_CREAT | os.O_RDWR, 0o666)
+    except OSError:
         return False
 
-    with LOCKFILE_PATH.open("w") as f:
-        f.write("%s,%s" % (datetime.datetime.utcnow(), getpass.getuser()))
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return False
+
+    os.ftruncate(fd, 0)
+    os.write(fd, ("%s,%s" % (
+        datetime.datetime.utcnow(), getpass.getuser())).encode())
+    _lockfile_fd = fd
     G.lockfile_held = True
     return True
 
 
+def _release_lockfile():
+    global _lockfile_fd
+
+    # The file is left in place: unlinking it could let another process lock
+    # a fresh file while a third still waits on the old one.
+    if G.lockfile_held and _lockfile_fd is not None:
+        os.close(_lockfile_fd)
+        _lockfile_fd = None
+        G.lockfile_held = False
+        logger.debug("shutdown: released lockfile at %s", LOCKFILE_PATH)
+
+
 def _get_shutdown_handler(cfg: config.Config):
     def handler():
+        if results.Reporters.codespeed:
+            results.Reporters.codespeed.flush()
+        if G.slack:
+            G.slack.flush()
+
         for node in bitcoind.Node.all_instances:
             if node.ps and node.ps.returncode is None:
                 node.terminate()
                 node.join()
 
-        # Release lockfile if we've got it
-        if G.lockfile_held:
-            LOCKFILE_PATH.unlink()
-            logger.debug("shutdown: removed lockfile at %s", LOCKFILE_PATH)
+        _release_lockfile()
+
+        # Unmount whether or not we tear down; a tmpfs left mounted keeps
+        # holding its memory.
+        _unmount_tmpfs()
 
         # Clean up to avoid filling disk
         # TODO add more granular cleanup options
@@ -233,7 +374,8 @@ def _get_shutdown_handler(cfg: config.Config):
 
             # For now only remove the bitcoin subdir, since that'll be far and
             # away the biggest subdir.
-            sh.run("rm -rf %s" % (cfg.workdir / "bitcoin"))
+            sh.rmtree(cfg.workdir / "bitcoin")
+            sh.rmtree(cfg.workdir / "worktrees")
             logger.info("shutdown: removed bitcoin dir at %s", cfg.workdir)
         elif not cfg.teardown:
             logger.info("shutdown: leaving bitcoin dir at %s", cfg.workdir)
@@ -261,9 +403,6 @@ cli.add_arg("--no-teardown", action="store_true")
 
 def _missing_pkgs() -> t.List[str]:
     errs = []
-    if "GNU time" not in sh.run("/usr/bin/time --version").stderr:
-        errs.append("Need to install GNU time (sudo apt install time)")
-
     if not sh.run("which fio", quiet=True).ok:
         errs.append("Need to install fio (sudo apt install fio)")
 
@@ -734,16 +873,25 @@ def run(yaml_filename: Path):
     logging.configure_logger(cfg.workdir, "DEBUG" if cli.args.verbose else "INFO")
 
     if cfg.codespeed:
-        results.Reporters.codespeed = results.CodespeedReporter(cfg.codespeed)
+        results.Reporters.codespeed = results.CodespeedReporter(
+            cfg.codespeed,
+            unsent_path=cfg.results_dir / "codespeed-unsent.jsonl")
 
-    G.slack = slack.Client(cfg.slack.webhook_url if cfg.slack else "")
-    slack.attach_slack_handler_to_logger(cfg, G.slack, logger)
+    if cfg.slack and cfg.slack.webhook_url:
+        G.slack = slack.Client(cfg.slack.webhook_url)
+        slack.attach_slack_handler_to_logger(cfg, G.slack, logger)
 
     atexit.register(_get_shutdown_handler(cfg))
 
+    if cfg.bench_cpus:
+        if sh.pin_runner(set(cfg.bench_cpus)):
+            logger.info("Pinning benchmarks to CPUs %s", sorted(cfg.bench_cpus))
+        else:
+            logger.warning("CPU pinning isn't supported on this platform")
+
     logger.info(
         "Started on host %s (codespeed env %s)",
-        config.HOSTNAME,
+        config.hostname(),
         cfg.codespeed.envname if cfg.codespeed else "[none]",
     )
     logger.info(str(cfg))
@@ -751,9 +899,10 @@ def run(yaml_filename: Path):
     try:
         completed = run_full_suite(cfg)
     except Exception:
-        G.slack.send_to_slack_attachment(
-            G.gitco, "Error", {}, text=traceback.format_exc(), success=False
-        )
+        if G.slack:
+            G.slack.send_to_slack_attachment(
+                G.gitco, "Error", {}, text=traceback.format_exc(), success=False
+            )
         raise
 
     if completed:
@@ -775,7 +924,10 @@ def _persist_results(cfg, results):
 
     try:
         results_path = cfg.results_dir / "results.pickle"
-        results_path.write_bytes(pickle.dumps(res_dict))
+        # Stream straight to the file rather than building the whole pickle
+        # in memory first.
+        with results_path.open('wb') as f:
+            pickle.dump(res_dict, f, protocol=pickle.HIGHEST_PROTOCOL)
         logger.info("Wrote serialized benchmark results to %s", results_path)
     except Exception:
         logger.exception("failed to pickle results")
@@ -784,7 +936,8 @@ def _persist_results(cfg, results):
 @cli.cmd
 def render(pickle_filename: Path):
     """Render (or re-render) the pickled results of a benchmark run."""
-    unpickled = pickle.loads(Path(pickle_filename).read_bytes())
+    with Path(pickle_filename).open('rb') as f:
+        unpickled = pickle.load(f)
     results.ALL_RUNS = unpickled["runs"]
     results.HWINFO = unpickled["hwinfo"]
 
@@ -810,11 +963,7 @@ def main():
     try:
         cli.run()
     except Exception:
-        # Release lockfile if we've got it
-        if G.lockfile_held:
-            LOCKFILE_PATH.unlink()
-            G.lockfile_held = False
-            logger.debug("shutdown: removed lockfile at %s", LOCKFILE_PATH)
+        _release_lockfile()
 
         raise
 
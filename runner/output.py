@@ -15,7 +15,7 @@ import matplotlib.pyplot as plt
 from .config import Config, Target
 from .benchmarks import Benchmark
 from .logging import get_logger
-from . import results
+from . import results, hwinfo
 
 logger = get_logger()
 
@@ -28,14 +28,14 @@ def format_val(bench_name, val):
 
 
 def get_times_table(grouped_runs):
-    timestr = "\n"
+    lines = [""]
     for name, target_to_benches in sorted(grouped_runs.items()):
         for target, benches in target_to_benches.items():
             for bench in benches:
-                timestr += "[{}] {}: {}\n".format(
-                    target.id, name, format_val(name, bench.results.total_time_secs))
+                lines.append("[{}] {}: {}".format(
+                    target.id, name, format_val(name, bench.results.total_time_secs)))
 
-    return timestr
+    return "\n".join(lines) + "\n"
 
 
 class BenchVal(namedtuple('BenchVal', 'name,values')):
@@ -45,7 +45,7 @@ class BenchVal(namedtuple('BenchVal', 'name,values')):
 
     @property
     def avg(self):
-        return sum(self.values) / self.count
+        return numpy.mean(self.values)
 
     @property
     def stddev(self):
@@ -361,19 +361,6 @@ def kib_to_mb(kib) -> float:
     return kib * 0.001024
 
 
-def get_processor_info() -> str:
-    cpuinfo_path = Path('/proc/cpuinfo')
-
-    if not cpuinfo_path.exists():
-        logger.warning("Couldn't detect CPU info")
-        return ''
-
-    lines = cpuinfo_path.read_text().splitlines()
-    modelname = [
-        i for i in lines if i.startswith('model name')][0].split(': ')[-1]
-    return modelname.strip()
-
-
 def _get_git_info(benches) -> str:
     out = '\n'
     for bench in benches:
@@ -515,7 +502,7 @@ def _make_ibd_type_plot(
     txt = plt.figtext(
         0.6, 0.02,
         "Benchmarks performed on\n{}{}".format(
-            get_processor_info(),
+            hwinfo.get_processor_name(),
             _get_git_info([i[0] for i in run_data.values()])))
     txt.set_fontfamily('sans-serif')
 
@@ -594,7 +581,7 @@ def _make_cache_flush_plot(
     txt = plt.figtext(
         0.6, 0.02,
         "Benchmarks performed on\n{}{}".format(
-            get_processor_info(),
+            hwinfo.get_processor_name(),
             _get_git_info([i[0] for i in run_data.values()])))
     txt.set_fontfamily('sans-serif')
 
@@ -642,7 +629,7 @@ def _make_microbench_plot(cfg, runs) -> Path:
     txt = plt.figtext(
         0.2, 0.02,
         "Benchmarks performed on {}{}".format(
-            get_processor_info(),
+            hwinfo.get_processor_name(),
             _get_git_info([i[0] for i in list(runs.values())[0].values()])))
     txt.set_fontfamily('sans-serif')
 
@@ -1,11 +1,15 @@
-import requests
+import json
+import queue
+import threading
 import typing as t
 from typing import Optional as Op
 from dataclasses import dataclass, field
+from pathlib import Path
 
 from .git import GitCheckout
 from .logging import get_logger
 from .logparse import FlushEvent
+from .util import http_session
 
 logger = get_logger()
 
@@ -14,6 +18,13 @@ ALL_RUNS: t.List['Benchmarks'] = []  # type: ignore # noqa: F821
 HWINFO: t.Dict = {}
 
 
+# The most results to send to codespeed in one request.
+MAX_CODESPEED_BATCH = 100
+
+# So that an unresponsive server can't hang `CodespeedReporter.flush()`.
+CODESPEED_TIMEOUT_SECS = 30
+
+
 class Reporters:
     """A container for Reporter instances - to be populated in runner/main"""
     codespeed: Op['CodespeedReporter'] = None
@@ -107,12 +118,23 @@ class FileReporter:
 
 
 class CodespeedReporter:
-    """Report results to codespeed."""
-    def __init__(self, codespeed_cfg):
+    """
+    Report results to codespeed.
+
+    Results are posted from a background thread so that benchmarks don't
+    block on the network; call `flush()` to wait for them to be sent.
+
+    Results that can't be sent are appended, one JSON object per line, to
+    `unsent_path` if given.
+    """
+    def __init__(self, codespeed_cfg, unsent_path: Op[Path] = None):
         self.server_url = codespeed_cfg.url
+        self.unsent_path = unsent_path
         self.codespeed_envname = codespeed_cfg.envname
         self.username = codespeed_cfg.username
         self.password = codespeed_cfg.password
+        self._queue: queue.Queue = queue.Queue()
+        self._sender: Op[threading.Thread] = None
 
     def save_result(self,
                     gitco: GitCheckout, benchmark_name, value,
@@ -188,7 +210,7 @@ class CodespeedReporter:
         if not self.server_url:
             return
 
-        self._result_add_http(data)
+        self._enqueue(data)
 
         # If the bench being reported is IBD or reindex, report the same result
         # additionally under a different name.
@@ -218,14 +240,83 @@ class CodespeedReporter:
             compat_bench_name = '.'.join(name_split)
 
         if compat_bench_name:
-            data['benchmark'] = compat_bench_name
-            self._result_add_http(data)
+            self._enqueue(dict(data, benchmark=compat_bench_name))
+
+    def flush(self):
+        """Block until all queued results have been posted."""
+        self._queue.join()
+
+    def _enqueue(self, data):
+        if not self._sender:
+            self._sender = threading.Thread(
+                target=self._drain_queue, name='codespeed', daemon=True)
+            self._sender.start()
+        self._queue.put(data)
+
+    def _drain_queue(self):
+        while True:
+            # Send whatever has piled up (e.g. a run of microbench results)
+            # in a single request.
+            batch = [self._queue.get()]
+            while len(batch) < MAX_CODESPEED_BATCH:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                self._send_batch(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _send_batch(self, batch):
+        """Post a batch, retrying once before setting it aside."""
+        for attempt in (1, 2):
+            try:
+                self._results_add_http(batch)
+                return
+            except Exception:
+                logger.exception(
+                    "failed to send %d results to codespeed (attempt %d)",
+                    len(batch), attempt)
+
+        if not self.unsent_path:
+            return
+        try:
+            with open(self.unsent_path, 'a') as f:
+                for data in batch:
+                    f.write(json.dumps(data) + '\n')
+            logger.warning(
+                "Saved %d unsent results to %s", len(batch), self.unsent_path)
+        except Exception:
+            logger.exception("failed to save unsent results")
+
+    def _results_add_http(self, batch):
+        if len(batch) == 1:
+            return self._result_add_http(batch[0])
+
+        url = self.server_url + '/result/add/json/'
+        logger.info("Posting %d results to %s", len(batch), url)
+        resp = http_session().post(
+            url, data={'json': json.dumps(batch)},
+            auth=(self.username, self.password), timeout=CODESPEED_TIMEOUT_SECS)
+
+        if resp.status_code != 202:
+            raise ValueError(
+                'Request to codespeed returned an error %s, '
+                'the response is:\n%s'
+                % (resp.status_code, resp.text)
+            )
+
+        return resp
 
     def _result_add_http(self, data):
         url = self.server_url + '/result/add/'
         logger.info("Posting data to %s:\n%s", url, data)
-        resp = requests.post(
-            url, data=data, auth=(self.username, self.password))
+        resp = http_session().post(
+            url, data=data, auth=(self.username, self.password),
+            timeout=CODESPEED_TIMEOUT_SECS)
 
         if resp.status_code != 202:
             raise ValueError(
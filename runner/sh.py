@@ -3,9 +3,12 @@ import logging
 import time
 import shutil
 import os
+import sys
 import tempfile
 import textwrap
 import re
+import select
+import shlex
 import typing as t
 from pathlib import Path
 from collections import namedtuple
@@ -16,7 +19,15 @@ from psutil import Process
 logger = logging.getLogger('bitcoinperf')
 
 
-def drop_caches(assert_drop: bool = False):
+def drop_caches(assert_drop: bool = False,
+                fallback_paths: t.Sequence[Path] = ()):
+    """
+    Drop the system page cache.
+
+    Args:
+        fallback_paths: if the system-wide drop isn't permitted, evict the
+            files under these paths from the page cache instead.
+    """
     ret = run("sync; sudo -n /sbin/swapoff -a;", check=False)
 
     if not ret.ok:
@@ -30,9 +41,14 @@ def drop_caches(assert_drop: bool = False):
 
     # N.B.: the host sudoer file needs to be configured to allow non-superusers
     # to run this command. See: https://unix.stackexchange.com/a/168670
-    ret2 = run("sudo -n /sbin/sysctl vm.drop_caches=3", check=False)
+    ret2 = run(["sudo", "-n", "/sbin/sysctl", "vm.drop_caches=3"], check=False)
 
-    if not ret2.ok:
+    if not ret2.ok and fallback_paths and evict_from_page_cache(fallback_paths):
+        logger.info(
+            "!!! couldn't drop caches; evicted only the files under %s. "
+            "You probably need to tune your /etc/sudoers file.",
+            ", ".join(str(p) for p in fallback_paths))
+    elif not ret2.ok:
         logger.info(
             "!!! couldn't drop caches! Bench results may be suspect! "
             "You probably need to tune your /etc/sudoers file.")
@@ -40,6 +56,33 @@ def drop_caches(assert_drop: bool = False):
             raise RuntimeError("failed to drop caches")
 
 
+def evict_from_page_cache(paths: t.Iterable[Path]) -> bool:
+    """
+    Ask the kernel to drop cached pages for all files under `paths`. Unlike
+    vm.drop_caches this doesn't need root, but dirty pages are only dropped
+    if they've been synced beforehand.
+
+    Returns False if the platform doesn't support it.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return False
+
+    for path in paths:
+        for root, _, files in os.walk(path):
+            for name in files:
+                try:
+                    fd = os.open(os.path.join(root, name), os.O_RDONLY)
+                except OSError:
+                    continue
+                try:
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+                except OSError:
+                    pass
+                finally:
+                    os.close(fd)
+    return True
+
+
 def cd(*args, **kwargs):
     os.chdir(*args, **kwargs)
     logger.debug(f"chdir -> {args[0]}")
@@ -56,12 +99,99 @@ def rm(path: Path):
         path.unlink()
 
 
-def popen(args, env=None, stdout=None, stderr=None):
+def rmtree(path: Path):
+    """
+    Remove a directory tree (or symlink) if it exists, logging anything that
+    couldn't be removed rather than raising.
+    """
+    if not os.path.lexists(path):
+        return
+    elif os.path.islink(path):
+        os.unlink(path)
+        return
+
+    def onerror(func, errpath, exc_info):
+        logger.warning("couldn't remove %s: %s", errpath, exc_info[1])
+
+    logger.debug(f"rmtree {path}")
+    shutil.rmtree(path, onerror=onerror)
+
+
+def copytree(src: Path, dest: Path, exclude: t.Collection[str] = ()):
+    """
+    Recursively copy a directory, sharing extents with the source when the
+    filesystem supports it (e.g. btrfs, XFS) and falling back to a full copy
+    otherwise.
+
+    Top-level entries of `src` named in `exclude` are skipped; in that case
+    the contents are copied into `dest`, which may already exist.
+    """
+    if not exclude:
+        ret = run(["cp", "-a", "--reflink=auto", str(src), str(dest)])
+        if ret.ok:
+            return
+
+        logger.debug("cp --reflink failed; falling back to shutil.copytree")
+        if Path(dest).exists():
+            shutil.rmtree(dest)
+        shutil.copytree(src, dest)
+        return
+
+    Path(dest).mkdir(parents=True, exist_ok=True)
+    srcs = [str(p) for p in Path(src).iterdir() if p.name not in exclude]
+    if not srcs or run(["cp", "-a", "--reflink=auto", *srcs, str(dest)]).ok:
+        return
+
+    logger.debug("cp --reflink failed; falling back to shutil.copytree")
+
+    def ignore(dir_, names):
+        return [n for n in names if n in exclude] if dir_ == str(src) else []
+
+    shutil.copytree(src, dest, ignore=ignore, dirs_exist_ok=True)
+
+
+# CPUs that benchmarked commands (see `Command`) are pinned to; set from the
+# config at startup.
+bench_cpus: t.Optional[t.Set[int]] = None
+
+
+def popen(args, env=None, stdout=None, stderr=None,
+          cpus: t.Optional[t.Set[int]] = None):
     logger.debug("Running command %r", args)
-    return subprocess.Popen(
+    ps = subprocess.Popen(
         args, env=env,
         stdout=(stdout or subprocess.PIPE),
-        stderr=(stderr or subprocess.PIPE), shell=True)
+        stderr=(stderr or subprocess.PIPE),
+        # Argument lists are exec'd directly, without a shell.
+        shell=isinstance(args, str))
+
+    if cpus:
+        # Pin straight after spawning rather than in a preexec_fn, which
+        # isn't safe with our background threads around (and rules out
+        # posix_spawn). The command has only just started, so threads and
+        # children it creates from here on inherit the affinity.
+        try:
+            os.sched_setaffinity(ps.pid, cpus)
+        except ProcessLookupError:
+            pass
+    return ps
+
+
+def pin_runner(cpus: t.Set[int]) -> bool:
+    """
+    Pin the benchmarked commands to `cpus`, and this process to the rest.
+    Returns False if CPU affinity isn't supported here.
+    """
+    global bench_cpus
+
+    if not hasattr(os, 'sched_setaffinity'):
+        return False
+
+    bench_cpus = set(cpus)
+    others = os.sched_getaffinity(0) - bench_cpus
+    if others:
+        os.sched_setaffinity(0, others)
+    return True
 
 
 class ResourceUsage(t.NamedTuple):
@@ -79,51 +209,162 @@ class ResourceUsage(t.NamedTuple):
         return int(self.memory_info[0] / 1024)
 
 
+# Only this much of the end of a command's output is kept in memory.
+OUTPUT_TAIL_BYTES = 1024 * 1024
+
+
+def read_tail(path: t.Union[str, Path], num_bytes: int) -> bytes:
+    """Return up to the last `num_bytes` of a file."""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(f.tell() - num_bytes, 0))
+        return f.read()
+
+
+# ru_maxrss is in KiB on Linux but in bytes on macOS.
+_MAXRSS_PER_KIB = 1024 if sys.platform == 'darwin' else 1
+
+
+def _status_to_returncode(status: int) -> int:
+    """Convert a wait status to a Popen-style returncode."""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
 class Command:
     """
     Manages the running of a subprocess for a certain benchmark.
 
-    Buffers output into tmpfiles to avoid blowing out memory. Allows easy
-    reporting of runtime characteristics like time, memory usage, CPU usage,
-    etc.
+    Buffers output into tmpfiles to avoid blowing out memory; only the tail of
+    each is read back. Allows easy reporting of runtime characteristics like
+    time, memory usage, CPU usage, etc.
     """
-    def __init__(self, cmd: str, bench_name: t.Optional[str] = None):
+    def __init__(self, cmd: t.Union[str, t.Sequence[str]],
+                 bench_name: t.Optional[str] = None,
+                 save_output_as: t.Optional[Path] = None,
+                 env: t.Optional[t.Dict[str, str]] = None,
+                 pin_to_bench_cpus: bool = True):
         """
         Args:
+            cmd: a shell command string, or an argument list to run without
+                a shell
+            env: extra environment variables to run the command with
+            pin_to_bench_cpus: run on `bench_cpus`, if set; only the commands
+                being benchmarked should
             bench_name: optional for logging context
+            save_output_as: if given, keep the full output at this path with
+                .stdout and .stderr suffixes
         """
-        self.cmd = cmd
+        self.args = cmd if isinstance(cmd, str) else list(cmd)
+        # A printable version of the command, used for logging and reporting.
+        self.cmd = cmd if isinstance(cmd, str) else shlex.join(self.args)
         self.bench_name = bench_name
+        self.save_output_as = save_output_as
+        self.env = env
+        self.pin_to_bench_cpus = pin_to_bench_cpus
         self.ps = None
         self.start_time = None
         self.end_time = None
         self.stdout = None
         self.stderr = None
+        self.rusage: t.Optional[t.Any] = None
         (self.stdout_fd, self.stdout_path) = tempfile.mkstemp(
             prefix='bitcoinperf-stdout-')
         (self.stderr_fd, self.stderr_path) = tempfile.mkstemp(
             prefix='bitcoinperf-stderr-')
 
     def start(self):
-        self.start_time = time.time()
+        self.start_time = time.perf_counter()
         self.ps = popen(
-            '$(which time) -f "%M;%S;%U" ' + self.cmd,
+            self.args,
+            env=({**os.environ, **self.env} if self.env else None),
             stdout=self.stdout_fd,
             stderr=self.stderr_fd,
+            cpus=(bench_cpus if self.pin_to_bench_cpus else None),
         )
         prefix = f"[{self.bench_name}] " if self.bench_name else ""
         logger.debug(f"{prefix}command '%s' starting", self.cmd)
 
+    def wait_for_exit(self, timeout: float) -> bool:
+        """
+        Sleep for up to `timeout` seconds, waking early if the process exits.
+        Returns True if it has exited.
+        """
+        assert self.ps
+        pidfd = None
+        if hasattr(os, 'pidfd_open') and self.ps.returncode is None:
+            try:
+                pidfd = os.pidfd_open(self.ps.pid)
+            except OSError:
+                # e.g. a pre-5.3 kernel, or the process is already gone.
+                pass
+
+        if pidfd is None:
+            time.sleep(timeout)
+        else:
+            try:
+                poller = select.poll()
+                poller.register(pidfd, select.POLLIN)
+                poller.poll(timeout * 1000)
+            finally:
+                os.close(pidfd)
+
+        return self.poll() is not None
+
+    def poll(self) -> t.Optional[int]:
+        """Return the returncode if the process has exited, else None."""
+        self._reap(block=False)
+        return self.returncode
+
     def join(self, timeout=None):
-        self.ps.wait(timeout=timeout)
-        self.end_time = time.time()
+        assert self.ps
+        deadline = None if timeout is None else time.perf_counter() + timeout
+
+        while not self._reap(block=(deadline is None)):
+            if deadline and time.perf_counter() > deadline:
+                raise subprocess.TimeoutExpired(self.cmd, timeout)
+            time.sleep(0.1)
+
         self._read_outputs()
 
+    def _reap(self, block: bool) -> bool:
+        """
+        Wait on the process ourselves (rather than through Popen) so that we
+        get its resource usage - including that of the children it waited on
+        - from the kernel. Returns True once the process has exited.
+        """
+        assert self.ps
+        if self.ps.returncode is not None:
+            return True
+
+        try:
+            pid, status, rusage = os.wait4(
+                self.ps.pid, 0 if block else os.WNOHANG)
+        except ChildProcessError:
+            # Reaped elsewhere, so resource usage is unavailable.
+            self.ps.wait()
+            pid, status, rusage = self.ps.pid, None, None
+
+        if not pid:
+            return False
+
+        self.end_time = time.perf_counter()
+        self.rusage = rusage
+        if status is not None:
+            self.ps.returncode = _status_to_returncode(status)
+        return True
+
     def _read_outputs(self):
-        self.stdout = Path(self.stdout_path).read_bytes()
-        self.stderr = Path(self.stderr_path).read_bytes()
-        os.unlink(self.stdout_path)
-        os.unlink(self.stderr_path)
+        self.stdout = read_tail(self.stdout_path, OUTPUT_TAIL_BYTES)
+        self.stderr = read_tail(self.stderr_path, OUTPUT_TAIL_BYTES)
+
+        for path, suffix in ((self.stdout_path, '.stdout'),
+                             (self.stderr_path, '.stderr')):
+            if self.save_output_as:
+                shutil.move(path, str(self.save_output_as) + suffix)
+            else:
+                os.unlink(path)
 
     @property
     def stderr_lines(self) -> t.List[str]:
@@ -139,7 +380,7 @@ class Command:
     def total_secs(self) -> float:
         assert self.start_time
         start = float(self.start_time)
-        return (self.end_time or time.time()) - start
+        return (self.end_time or time.perf_counter()) - start
 
     @property
     def returncode(self) -> int:
@@ -150,12 +391,12 @@ class Command:
         """
         Returns (max_rss, cpu_kernel_secs, cpu_user_secs)
         """
-        assert self.stderr
-        line = self.stderr.decode().strip().split('\n')[-1].strip()
-
-        # Based upon the `time` format specified in `start()`
-        (maxrss, cpukernel, cpuuser) = line.split(';')
-        return (int(maxrss), float(cpukernel), float(cpuuser))
+        assert self.rusage, "resource usage is only known after join()"
+        return (
+            self.rusage.ru_maxrss // _MAXRSS_PER_KIB,
+            self.rusage.ru_stime,
+            self.rusage.ru_utime,
+        )
 
     def cpu_kernel_secs(self) -> float:
         return self.time_output()[1]
@@ -166,7 +407,6 @@ class Command:
     def memusage_kib(self) -> int:
         if self.returncode is None:
             return self.get_resource_usage().rss_kb
-        assert self.stderr
         return self.time_output()[0]
 
     def check_for_failure(self):
@@ -196,12 +436,12 @@ class Command:
                 """
                 Process graph looks like this:
 
-                    sh(327)───time(334)───bitcoind(335)
+                    sh(327)───bitcoind(335)
                 """
                 name = proc_.name()
 
                 # Recurse into child processes if need be.
-                if name in ['sh', 'time']:
+                if name == 'sh':
                     assert len(proc_.children()) == 1
                     return find_process(proc_.children()[0])
 
@@ -236,13 +476,18 @@ class RunReturn(namedtuple('RunReturn', 'args,returncode,stdout,stderr')):
         return f"{msg}:\n{self.output}"
 
 
-def run(cmd: str,
+def run(cmd: t.Union[str, t.Sequence[str]],
         check: bool = False,
         quiet: bool = False,
         **kwargs) -> RunReturn:
-    """Run a command synchonrously."""
+    """
+    Run a command synchonrously.
+
+    A string is interpreted by the shell; an argument list is executed
+    directly, which skips starting a shell.
+    """
     kwargs.setdefault('text', True)
-    kwargs.setdefault('shell', True)
+    kwargs.setdefault('shell', isinstance(cmd, str))
     kwargs.setdefault('stdout', subprocess.PIPE)
     kwargs.setdefault('stderr', subprocess.PIPE)
 
@@ -251,7 +496,11 @@ def run(cmd: str,
         kwargs['stderr'] = subprocess.DEVNULL
 
     logger.debug("Running cmd '%s': '%s'", cmd, kwargs)
-    r = RunReturn.from_std(subprocess.run(cmd, **kwargs))
+    try:
+        r = RunReturn.from_std(subprocess.run(cmd, **kwargs))
+    except FileNotFoundError as e:
+        # Report a missing executable the way the shell would.
+        r = RunReturn(cmd, 127, '', str(e))
 
     if not r.ok:
         cmd_failed = (
@@ -1,23 +1,47 @@
-import requests
 import json
 import logging
 import logging.handlers
+import queue
+import threading
+import typing as t
 
 from . import config
 from .globals import G
 from .git import GitCheckout
+from .logging import add_queued_handlers, get_logger
+from .util import http_session
+
+
+logger = get_logger()
 
 
 class Client:
+    """
+    Posts messages to a slack webhook.
+
+    Messages are sent from a background thread so that benchmarks don't
+    block on the network; call `flush()` to wait for them to be sent.
+    """
     def __init__(self, webhook_url=None):
         self.webhook_url = webhook_url
+        self._queue: queue.Queue = queue.Queue()
+        self._sender: t.Optional[threading.Thread] = None
 
     def send_to_slack_txt(self, cfg, txt):
-        self._send_to_slack({'text': "[%s] %s" % (config.HOSTNAME, txt)})
+        self._enqueue({'text': "[%s] %s" % (config.hostname(), txt)})
 
     def send_to_slack_attachment(
             self, gitco: GitCheckout, title, fields, text="", success=True):
-        fields['Host'] = config.HOSTNAME
+        self._enqueue(
+            self._attachment_data(gitco, title, fields, text, success))
+
+    def flush(self):
+        """Block until all queued messages have been posted."""
+        self._queue.join()
+
+    def _attachment_data(
+            self, gitco: GitCheckout, title, fields, text="", success=True):
+        fields['Host'] = config.hostname()
         fields['Commit'] = (getattr(gitco, 'sha', ''))[:6]
         fields['Ref'] = getattr(gitco, 'ref', '')
 
@@ -35,13 +59,33 @@ class Client:
         if text:
             data['attachments'][0]['text'] = text
 
-        self._send_to_slack(data)
+        return data
+
+    def _enqueue(self, slack_data):
+        if not self.webhook_url:
+            return
+        if not self._sender:
+            self._sender = threading.Thread(
+                target=self._drain_queue, name='slack', daemon=True)
+            self._sender.start()
+        self._queue.put(slack_data)
+
+    def _drain_queue(self):
+        while True:
+            slack_data = self._queue.get()
+            try:
+                self._send_to_slack(slack_data)
+            except Exception:
+                # Not logger.exception, which would feed back into slack.
+                logger.debug("failed to send to slack", exc_info=True)
+            finally:
+                self._queue.task_done()
 
     def _send_to_slack(self, slack_data):
         if not self.webhook_url:
             return
 
-        response = requests.post(
+        response = http_session().post(
             self.webhook_url, data=json.dumps(slack_data),
             headers={'Content-Type': 'application/json'}
         )
@@ -64,9 +108,12 @@ class SlackLogHandler(logging.Handler):
         # If the log is multiple lines, treat the first line as the title and
         # the remainder as text.
         title, *rest = fmtd.split('\n', 1)
-        return self.client.send_to_slack_attachment(
+
+        # We're already off of the logging caller's thread (see
+        # `attach_slack_handler_to_logger()`), so post directly.
+        return self.client._send_to_slack(self.client._attachment_data(
             G.gitco, title, {},
-            text=(rest[0] if rest else None), success=False)
+            text=(rest[0] if rest else None), success=False))
 
 
 def attach_slack_handler_to_logger(cfg, client: Client, logger):
@@ -74,4 +121,5 @@ def attach_slack_handler_to_logger(cfg, client: Client, logger):
     slack = SlackLogHandler(cfg, client)
     slack.setLevel(logging.WARNING)
     slack.setFormatter(logging.Formatter('%(message)s'))
-    logger.addHandler(slack)
+    # Posting to slack is slow, so keep it off of the logging caller's thread.
+    add_queued_handlers(logger, slack)
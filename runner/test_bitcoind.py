@@ -0,0 +1,38 @@
+from . import bitcoind, config, git, sh
+
+
+def test_build_cache_restore_into_new_worktree(monkeypatch, tmp_path):
+    origin = tmp_path / 'origin'
+    origin.mkdir()
+    monkeypatch.chdir(origin)
+    sh.run('git init -q . && git -c user.name=a -c user.email=a@b '
+           'commit -q --allow-empty -m first', check=True)
+    sha = sh.run('git rev-parse HEAD').stdout.strip()
+    gitco = config.GitCheckout(
+        ref='master', remote='origin', sha=sha, commit_msg='first',
+        name='master')
+    target = config.Target(gitref='master', gitco=gitco)
+    monkeypatch.setattr(bitcoind, '_assert_version', lambda *args: None)
+
+    def new_worktree(run):
+        repo = tmp_path / run / 'bitcoin'
+        sh.run(f'git clone -q {origin} {repo}', check=True)
+        return git.add_worktree(repo, gitco)
+
+    cachedir = tmp_path / 'build-cache'
+    worktree = new_worktree('run1')
+    (worktree / 'src').mkdir()
+    (worktree / 'src' / 'bitcoind').write_text('built')
+    bitcoind.BuildCache(
+        tmp_path / 'run1', config.Compilers.gcc, cachedir, repo_path=worktree,
+    ).save(target)
+    sh.rmtree(tmp_path / 'run1')
+
+    # A later run restores into its own worktree, whose .git must survive.
+    worktree = new_worktree('run2')
+    assert bitcoind.BuildCache(
+        tmp_path / 'run2', config.Compilers.gcc, cachedir, repo_path=worktree,
+    ).restore(target)
+    assert (worktree / 'src' / 'bitcoind').read_text() == 'built'
+    assert git.read_head_sha(worktree) == sha
+    assert git.git(worktree, 'status --porcelain').ok
@@ -1,7 +1,7 @@
 import shutil
+import socket
 from pathlib import Path
 
-import yaml
 import pytest
 
 from . import config
@@ -29,7 +29,7 @@ def setup_files():
 
 
 def test_parse_config(setup_files):
-    c = config.Config(**yaml.load(TEST_CFG, Loader=yaml.Loader))
+    c = config.load(TEST_CFG)
 
     assert [i[0] for i in c.benches] == [
         'build',
@@ -135,3 +135,70 @@ to_bench:
   - gitref: 1905-buildStackReuseNone
     gitremote: MarcoFalke
 """
+
+
+def test_codespeed_requires_credentials(monkeypatch):
+    monkeypatch.setenv('CODESPEED_PASSWORD', 'hunter2')
+    c = config.Codespeed(
+        url='http://codespeed:8000', username='admin',
+        password='${CODESPEED_PASSWORD}')
+    assert c.password == 'hunter2'
+
+    monkeypatch.delenv('CODESPEED_PASSWORD')
+    with pytest.raises(ValueError):
+        config.Codespeed(
+            url='http://codespeed:8000', username='admin',
+            password='${CODESPEED_PASSWORD}')
+
+    with pytest.raises(ValueError):
+        config.Codespeed(url='http://codespeed:8000', username='', password='x')
+
+
+def test_is_port_open():
+    with socket.socket() as listener:
+        listener.bind(("127.0.0.1", 0))
+        listener.listen()
+        addr = "127.0.0.1:{}".format(listener.getsockname()[1])
+        assert config.is_port_open(addr) == addr
+
+    # The listener is closed now, so nothing should be accepting connections.
+    with pytest.raises(ValueError):
+        config.is_port_open(addr)
+
+    with pytest.raises(ValueError):
+        config.is_port_open("127.0.0.1:notaport")
+
+
+def test_target_cache_key():
+    def target(**kwargs):
+        tar = config.Target(gitref='master', **kwargs)
+        tar.gitco = config.GitCheckout(
+            ref='master', remote='origin', sha='ab' * 20, commit_msg='', name='')
+        return tar
+
+    key = target().cache_key(config.Compilers.gcc)
+    assert key.startswith('master-')
+
+    # Runtime-only differences share a build.
+    assert target(
+        bitcoind_extra_args='-dbcache=4000', name='foo',
+    ).cache_key(config.Compilers.gcc) == key
+
+    assert target().cache_key(config.Compilers.clang) != key
+    assert target(
+        configure_args='--enable-debug').cache_key(config.Compilers.gcc) != key
+
+    with pytest.raises(ValueError):
+        config.Target(gitref='master').cache_key(config.Compilers.gcc)
+
+
+def test_target_id():
+    assert config.Target(gitref='master').id == 'master-'
+
+    # Targets differing only in bitcoind's environment get distinct ids.
+    one = config.Target(gitref='master', bitcoind_env={'MALLOC_ARENA_MAX': '1'})
+    two = config.Target(gitref='master', bitcoind_env={'MALLOC_ARENA_MAX': '2'})
+    assert one.id.startswith('master--env')
+    assert one.id != two.id
+    assert one.id == config.Target(
+        gitref='master', bitcoind_env={'MALLOC_ARENA_MAX': '1'}).id
@@ -0,0 +1,83 @@
+from . import git, sh
+
+
+def test_get_repo_doesnt_fetch_all(monkeypatch, tmp_path):
+    cmds = []
+
+    def fake_run(cmd, *args, **kwargs):
+        cmds.append(cmd)
+        return sh.RunReturn(cmd, 0, '', '')
+
+    monkeypatch.setattr(sh, 'run', fake_run)
+
+    git.get_repo(tmp_path / 'bitcoin', cached_okay=False)
+    assert len(cmds) == 1 and cmds[0].startswith('git clone ')
+
+    # An existing repo is left for `resolve_targets()` to update.
+    (tmp_path / 'bitcoin').mkdir()
+    git.get_repo(tmp_path / 'bitcoin', cached_okay=False)
+    assert len(cmds) == 1
+    assert not [c for c in cmds if '--all' in c]
+
+
+def test_ref_lookup_cache(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    sh.run('git init -q . && git -c user.name=a -c user.email=a@b '
+           'commit -q --allow-empty -m first', check=True)
+    git.clear_git_cache()
+    git._get_commit_msg.cache_clear()
+
+    sha = git.get_sha('HEAD')
+    assert git.get_commit_msg(sha) == 'first'
+    assert git.get_commit_msg(sha) == 'first'
+    assert git._get_commit_msg.cache_info().hits == 1
+
+    # HEAD is never served from the cache since it moves with every commit.
+    sh.run('git -c user.name=a -c user.email=a@b '
+           'commit -q --allow-empty -m second', check=True)
+    assert git.get_sha('HEAD') != sha
+    assert git.get_commit_msg('HEAD') == 'second'
+
+
+def test_read_head_sha(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    sh.run('git init -q . && git -c user.name=a -c user.email=a@b '
+           'commit -q --allow-empty -m first', check=True)
+    sha = sh.run('git rev-parse HEAD').stdout.strip()
+    assert git.read_head_sha(tmp_path) == sha
+
+    sh.run(f'git worktree add -q --detach wt {sha}', check=True)
+    assert git.read_head_sha(tmp_path / 'wt') == sha
+
+    # A branch checked out in a worktree resolves via the main git dir.
+    sh.run('git worktree add -q -b wtbranch wt2', check=True)
+    assert git.read_head_sha(tmp_path / 'wt2') == sha
+
+    sh.run('git pack-refs --all', check=True)
+    assert git.read_head_sha(tmp_path) == sha
+    assert git.read_head_sha(tmp_path / 'wt2') == sha
+    assert git.get_sha('HEAD') == sha
+
+
+def test_cache_repo_marker(monkeypatch, tmp_path):
+    cache_path = tmp_path / 'bitcoin.cached.git'
+    cmds = []
+
+    def fake_run(cmd, *args, **kwargs):
+        cmds.append(cmd)
+        cache_path.mkdir()
+        return sh.RunReturn(cmd, 0, '', '')
+
+    monkeypatch.setattr(git, 'git_cache_path', lambda: cache_path)
+    monkeypatch.setattr(sh, 'run', fake_run)
+
+    # A cache without a marker, e.g. from an interrupted clone, is recreated.
+    cache_path.mkdir()
+    (cache_path / 'HEAD').touch()
+    assert git.cache_repo()
+    assert len(cmds) == 1
+    assert not (cache_path / 'HEAD').exists()
+
+    # Once marked, the cache is used as-is.
+    assert git.cache_repo()
+    assert len(cmds) == 1
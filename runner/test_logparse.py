@@ -1,3 +1,7 @@
+import datetime
+
+import pytest
+
 from . import logparse
 
 
@@ -6,3 +10,11 @@ def test_logparse(datadir):
         assert logparse.get_flush_times(f) == [
             logparse.FlushEvent(9, 0.00, 1201, 276),
             logparse.FlushEvent(9, 0.00, 0, 11)]
+
+
+def test_parse_date():
+    assert logparse.parse_date('2019-09-20T17:22:33Z') == \
+        datetime.datetime(2019, 9, 20, 17, 22, 33)
+
+    with pytest.raises(ValueError):
+        logparse.parse_date('2019-09-20 17:22:33')
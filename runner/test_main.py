@@ -0,0 +1,22 @@
+import os
+import time
+
+from . import config, main
+
+
+def test_cleanup_tmpfiles(monkeypatch, tmp_path):
+    runs = tmp_path / 'runs'
+    monkeypatch.setattr(config, 'workdir_path', runs)
+
+    # A missing runs dir (e.g. a fresh home with `workdir` set) is fine.
+    main._cleanup_tmpfiles()
+    assert runs.is_dir()
+
+    now = time.time()
+    for i in range(main.KEEP_RUN_DIRS + 2):
+        (runs / f'run{i}').mkdir()
+        os.utime(runs / f'run{i}', (now - 100 + i, now - 100 + i))
+
+    main._cleanup_tmpfiles()
+    assert sorted(p.name for p in runs.iterdir()) == [
+        f'run{i}' for i in range(2, main.KEEP_RUN_DIRS + 2)]
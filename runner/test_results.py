@@ -0,0 +1,26 @@
+import json
+import types
+
+from . import results
+
+
+def test_codespeed_unsent_batch_saved(monkeypatch, tmp_path):
+    codespeed_cfg = types.SimpleNamespace(
+        url='http://codespeed', envname='env', username='u', password='p')
+    unsent = tmp_path / 'unsent.jsonl'
+    reporter = results.CodespeedReporter(codespeed_cfg, unsent_path=unsent)
+
+    attempts = []
+
+    def fail(batch):
+        attempts.append(batch)
+        raise ValueError('codespeed is down')
+
+    monkeypatch.setattr(reporter, '_results_add_http', fail)
+    reporter._enqueue({'benchmark': 'micro.gcc.Foo', 'result_value': 1.0})
+    reporter.flush()
+
+    # Retried once, then kept rather than dropped.
+    assert len(attempts) == 2
+    assert [json.loads(line) for line in unsent.read_text().splitlines()] == [
+        {'benchmark': 'micro.gcc.Foo', 'result_value': 1.0}]
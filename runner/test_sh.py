@@ -1,3 +1,5 @@
+import os
+
 import pytest
 
 from . import sh
@@ -20,3 +22,120 @@ def test_run():
     assert ret.returncode != 0
     assert 'No such file or directory' in ret.stderr
     assert ret.stdout == ""
+
+    ret = sh.run(["hopefullynonexistentbinary", "arg"])
+    assert ret.returncode == 127
+    assert not ret.ok
+
+
+def test_command_output(monkeypatch, tmp_path):
+    monkeypatch.setattr(sh, 'OUTPUT_TAIL_BYTES', 4)
+
+    cmd = sh.Command("printf 'abcdefgh'", save_output_as=tmp_path / 'out')
+    cmd.start()
+    cmd.join()
+
+    # Only the tail is kept in memory, but the full output is saved.
+    assert cmd.stdout == b'efgh'
+    assert (tmp_path / 'out.stdout').read_bytes() == b'abcdefgh'
+    assert (tmp_path / 'out.stderr').exists()
+
+
+def test_command_argv():
+    # Argument lists skip the shell, so nothing is word-split or expanded.
+    cmd = sh.Command(['printf', '%s|', 'a b', '$HOME'])
+    cmd.start()
+    cmd.join()
+
+    assert cmd.stdout == b'a b|$HOME|'
+    assert cmd.cmd == "printf '%s|' 'a b' '$HOME'"
+
+
+def test_command_env():
+    cmd = sh.Command(['sh', '-c', 'printf "$MALLOC_ARENA_MAX:$HOME"'],
+                     env={'MALLOC_ARENA_MAX': '1'})
+    cmd.start()
+    cmd.join()
+
+    # Extra variables are added to, rather than replacing, the environment.
+    assert cmd.stdout == f"1:{os.environ['HOME']}".encode()
+
+
+def test_command_resource_usage():
+    cmd = sh.Command("python3 -c 'bytearray(50 * 1024 * 1024)'")
+    cmd.start()
+    cmd.join()
+
+    assert cmd.returncode == 0
+    assert cmd.memusage_kib() > 50 * 1024
+    assert cmd.cpu_user_secs() >= 0
+
+    cmd = sh.Command("exit 3")
+    cmd.start()
+    cmd.join(timeout=5)
+    assert cmd.returncode == 3
+
+
+@pytest.mark.skipif(not hasattr(os, 'posix_fadvise'), reason='needs fadvise')
+def test_evict_from_page_cache(tmp_path):
+    (tmp_path / 'sub').mkdir()
+    (tmp_path / 'sub' / 'blk00000.dat').write_bytes(b'x' * 4096)
+    assert sh.evict_from_page_cache([tmp_path])
+
+
+def test_command_wait_for_exit():
+    cmd = sh.Command("sleep 0.2")
+    cmd.start()
+    assert not cmd.wait_for_exit(0.01)
+    assert cmd.wait_for_exit(5)
+    assert cmd.returncode == 0
+    cmd.join()
+
+
+@pytest.mark.skipif(
+    not hasattr(os, 'sched_setaffinity'), reason='needs CPU affinity')
+def test_command_bench_cpus(monkeypatch):
+    cpu = min(os.sched_getaffinity(0))
+    monkeypatch.setattr(sh, 'bench_cpus', {cpu})
+
+    cmd = sh.Command(
+        "python3 -c 'import os; print(sorted(os.sched_getaffinity(0)))'")
+    cmd.start()
+    cmd.join()
+    assert cmd.stdout.decode().strip() == str([cpu])
+
+    cmd = sh.Command(
+        "python3 -c 'import os; print(sorted(os.sched_getaffinity(0)))'",
+        pin_to_bench_cpus=False)
+    cmd.start()
+    cmd.join()
+    assert cmd.stdout.decode().strip() == str(sorted(os.sched_getaffinity(0)))
+
+
+def test_copytree(tmp_path):
+    # Paths are passed to cp as-is, without a shell to split or expand them.
+    src = tmp_path / 'src dir $HOME'
+    (src / 'sub').mkdir(parents=True)
+    (src / 'sub' / 'f').write_text('x')
+
+    dest = tmp_path / 'dest; touch oops'
+    sh.copytree(src, dest)
+
+    assert (dest / 'sub' / 'f').read_text() == 'x'
+    assert not (tmp_path / 'oops').exists()
+
+
+def test_copytree_exclude(tmp_path):
+    src = tmp_path / 'src'
+    (src / 'sub').mkdir(parents=True)
+    (src / 'sub' / '.git').write_text('inner')
+    (src / '.git').write_text('outer')
+
+    dest = tmp_path / 'dest'
+    dest.mkdir()
+    (dest / '.git').write_text('kept')
+    sh.copytree(src, dest, exclude={'.git'})
+
+    # Only top-level entries are excluded.
+    assert (dest / '.git').read_text() == 'kept'
+    assert (dest / 'sub' / '.git').read_text() == 'inner'
@@ -1,3 +1,4 @@
+import functools
 import itertools
 import hashlib
 
@@ -14,6 +15,28 @@ def is_hex(s: str) -> bool:
     return True
 
 
+@functools.lru_cache(maxsize=1)
+def http_session():
+    """
+    Return the requests.Session shared by codespeed and slack reporting so
+    that repeated posts reuse connections.
+
+    Only connection errors are retried; POSTs that reach the server aren't.
+    """
+    # Imported lazily since most runs don't make any HTTP requests.
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=4, pool_maxsize=16,
+        max_retries=Retry(total=3, backoff_factor=0.2))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
 def shuffled_sequence(seed: int, items: list, run_count: int):
     """
     Args: